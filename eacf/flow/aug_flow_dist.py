@@ -28,6 +28,7 @@ class AugmentedFlowRecipe(NamedTuple):
     dim_x: int
     n_augmented: int  # number of augmented variables, each of dimension dim_x.
     compile_n_unroll: int = 1
+    remat_layers: bool = False  # Recompute each flow layer's activations in the backward pass, to save memory.
 
 
 class AugmentedFlowParams(NamedTuple):
@@ -102,8 +103,10 @@ class AugmentedFlow(NamedTuple):
 def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
     """Create an `AugmentedFlow` given the provided definition.
 
-    Make use of `jax.lax.scan` over flow blocks to keep compile time from being too long.
+    Make use of `jax.lax.scan` over flow blocks to keep compile time from being too long. The graph features are loop
+    invariant, so only the positions and log det are carried through these scans.
     """
+    maybe_remat = jax.checkpoint if recipe.remat_layers else lambda fn: fn
 
     @hk.without_apply_rng
     @hk.transform
@@ -113,7 +116,8 @@ def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
         assert len(sample_shape) in (0, 1)
         if len(sample_shape) == 1:
             # Broadcast graph features to batch.
-            graph_features = jax.tree_map(lambda x: jnp.repeat(x[None, ...], sample_shape[0], axis=0),
+            graph_features = jax.tree_util.tree_map(lambda x: jnp.broadcast_to(x[None, ...],
+                                                                               (sample_shape[0], *x.shape)),
                                           graph_features)
         return FullGraphSample(positions=positions, features=graph_features)
 
@@ -171,15 +175,17 @@ def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
     ) -> Tuple[FullGraphSample, LogDet, Extra]:
         def scan_fn(carry, bijector_params):
             x, log_det_prev = carry
-            y, log_det, extra = bijector_forward_and_log_det_with_extra_single.apply(bijector_params, x)
+            y, log_det, extra = bijector_forward_and_log_det_with_extra_single.apply(
+                bijector_params, sample._replace(positions=x))
             chex.assert_equal_shape((log_det_prev, log_det))
-            return (y, log_det_prev + log_det), extra
+            return (y.positions, log_det_prev + log_det), extra
 
         if layer_indices is not None:
-            params = jax.tree_map(lambda x: x[layer_indices[0]:layer_indices[1]], params)
-        (y, log_det), extra = jax.lax.scan(scan_fn, init=(sample, jnp.zeros(sample.positions.shape[:-3])),
+            params = jax.tree_util.tree_map(lambda x: x[layer_indices[0]:layer_indices[1]], params)
+        (y, log_det), extra = jax.lax.scan(maybe_remat(scan_fn), init=(sample.positions, jnp.zeros(sample.positions.shape[:-3])),
                                            xs=params,
                                            unroll=recipe.compile_n_unroll)
+        y = sample._replace(positions=y)
         info = {}
         aggregators = {}
         for i in range(recipe.n_layers):
@@ -196,9 +202,10 @@ def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
 
         def scan_fn(carry, bijector_params):
             y, log_det_prev = carry
-            x, log_det, extra = bijector_inverse_and_log_det_with_extra_single.apply(bijector_params, y)
+            x, log_det, extra = bijector_inverse_and_log_det_with_extra_single.apply(
+                bijector_params, sample._replace(positions=y))
             chex.assert_equal_shape((log_det_prev, log_det))
-            return (x, log_det_prev + log_det), extra
+            return (x.positions, log_det_prev + log_det), extra
 
         # Restrict to zero-CoM subspace before passing through bijector.
         x = sample.positions[..., 0, :]
@@ -207,10 +214,11 @@ def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
         log_prob_shape = sample.positions.shape[:-3]
 
         if layer_indices is not None:
-            params = jax.tree_map(lambda x: x[layer_indices[0]:layer_indices[1]], params)
-        (x, log_det), extra = jax.lax.scan(scan_fn, init=(sample, jnp.zeros(log_prob_shape)),
+            params = jax.tree_util.tree_map(lambda x: x[layer_indices[0]:layer_indices[1]], params)
+        (x, log_det), extra = jax.lax.scan(maybe_remat(scan_fn), init=(sample.positions, jnp.zeros(log_prob_shape)),
                                            xs=params,
                                            reverse=True, unroll=recipe.compile_n_unroll)
+        x = sample._replace(positions=x)
 
         info = {}
         aggregators = {}
@@ -224,9 +232,9 @@ def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
     def log_prob_apply(params: AugmentedFlowParams, sample: FullGraphSample) -> LogProb:
         def scan_fn(carry, bijector_params):
             y, log_det_prev = carry
-            x, log_det = bijector_inverse_and_log_det_single.apply(bijector_params, y)
+            x, log_det = bijector_inverse_and_log_det_single.apply(bijector_params, sample._replace(positions=y))
             chex.assert_equal_shape((log_det_prev, log_det))
-            return (x, log_det_prev + log_det), None
+            return (x.positions, log_det_prev + log_det), None
 
         # Restrict to zero CoM subspace before passing through bijector.
         x = sample.positions[..., 0, :]   # Regular coordinates only (as we centre on this).
@@ -234,9 +242,10 @@ def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
         sample = sample._replace(positions=sample.positions - jnp.expand_dims(centre_of_mass_x, axis=-2))
 
         log_prob_shape = sample.positions.shape[:-3]
-        (x, log_det), _ = jax.lax.scan(scan_fn, init=(sample, jnp.zeros(log_prob_shape)),
+        (x, log_det), _ = jax.lax.scan(maybe_remat(scan_fn), init=(sample.positions, jnp.zeros(log_prob_shape)),
                                        xs=params.bijector, reverse=True,
                                        unroll=recipe.compile_n_unroll)
+        x = sample._replace(positions=x)
         base_log_prob = base_log_prob_fn.apply(params.base, x)
         chex.assert_equal_shape((base_log_prob, log_det))
         return base_log_prob + log_det
@@ -254,16 +263,18 @@ def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
 
     def sample_and_log_prob_apply(params: AugmentedFlowParams, features: GraphFeatures,
                                   key: chex.PRNGKey, shape: chex.Shape) -> Tuple[FullGraphSample, LogProb]:
+        x = base_sample_fn.apply(params.base, features, key, shape)
+        base_log_prob = base_log_prob_fn.apply(params.base, x)
+
         def scan_fn(carry, bijector_params):
-            x, log_det_prev = carry
-            y, log_det = bijector_forward_and_log_det_single.apply(bijector_params, x)
+            x_positions, log_det_prev = carry
+            y, log_det = bijector_forward_and_log_det_single.apply(bijector_params, x._replace(positions=x_positions))
             chex.assert_equal_shape((log_det_prev, log_det))
-            return (y, log_det_prev + log_det), None
+            return (y.positions, log_det_prev + log_det), None
 
-        x = base_sample_fn.apply(params.base, features, key, shape)
-        base_log_prob = base_log_prob_fn.apply(params.base, x)
-        (y, log_det), _ = jax.lax.scan(scan_fn, init=(x, jnp.zeros(x.positions.shape[:-3])), xs=params.bijector,
-                                       unroll=recipe.compile_n_unroll)
+        (y, log_det), _ = jax.lax.scan(maybe_remat(scan_fn), init=(x.positions, jnp.zeros(x.positions.shape[:-3])),
+                                       xs=params.bijector, unroll=recipe.compile_n_unroll)
+        y = x._replace(positions=y)
         chex.assert_equal_shape((base_log_prob, log_det))
         log_prob = base_log_prob - log_det
         return y, log_prob
@@ -284,15 +295,6 @@ def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
 
         return y, log_prob, extra
 
-    @hk.without_apply_rng
-    @hk.transform
-    def aux_target_log_prob(joint_sample: FullGraphSample) -> LogProb:
-        features, positions_x, positions_a = joint_to_separate_samples(joint_sample)
-        dist = recipe.make_aug_target(FullGraphSample(positions=positions_x, features=features))
-        positions_a, log_prob = dist.log_prob(positions_a)
-        return log_prob
-
-
     @hk.without_apply_rng
     @hk.transform
     def aux_target_sample_n_and_log_prob(sample_x: FullGraphSample, key: chex.PRNGKey, n: Optional[int] = None) -> \
@@ -318,10 +320,10 @@ def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
 
     @hk.without_apply_rng
     @hk.transform
-    def aux_target_log_prob(sample_x: FullGraphSample, postions_a: Positions) -> LogProb:
+    def aux_target_log_prob(sample_x: FullGraphSample, positions_a: Positions) -> LogProb:
         dist = recipe.make_aug_target(sample_x)
-        chex.assert_tree_shape_suffix(postions_a, dist.event_shape)
-        log_prob = dist.log_prob(postions_a)
+        chex.assert_tree_shape_suffix(positions_a, dist.event_shape)
+        log_prob = dist.log_prob(positions_a)
         return log_prob
 
 
@@ -341,8 +343,8 @@ def create_flow(recipe: AugmentedFlowRecipe) -> AugmentedFlow:
                                                       sample.positions, sample_a)
         params_base = base_log_prob_fn.init(key3, sample_joint)
         params_bijector_single = bijector_inverse_and_log_det_single.init(key4, sample_joint)
-        params_bijectors = jax.tree_map(lambda x: jnp.repeat(x[None, ...], recipe.n_layers, axis=0),
-                                        params_bijector_single)
+        params_bijectors = jax.tree_util.tree_map(
+            lambda x: jnp.broadcast_to(x[None, ...], (recipe.n_layers, *x.shape)), params_bijector_single)
         return AugmentedFlowParams(base=params_base, bijector=params_bijectors, aux_target=params_aux_target)
 
     def sample_apply(*args, **kwargs):
@@ -1,5 +1,8 @@
+import os
+
 import chex
 import jax
+import pytest
 
 from eacf.utils.test import assert_is_invariant
 
@@ -8,7 +11,16 @@ from eacf.flow.x_base_dist import CentreGravityGaussian, HarmonicPotential, \
     AldpTransformedInternals, assert_mean_zero
 
 
-def test_base_distribution():
+ALDP_DATA_PATH = os.path.join(os.path.dirname(__file__), '..', 'targets', 'data', 'aldp_500K_train_mini.h5')
+
+
+@pytest.mark.parametrize("x_dist_type", [
+    'centre_gravity_gaussian',
+    'harmonic_potential',
+    pytest.param('aldp_transformed_internals',
+                 marks=pytest.mark.skipif(not os.path.exists(ALDP_DATA_PATH), reason="ALDP data not available.")),
+])
+def test_base_distribution(x_dist_type: str):
     """Test that the base distribution does not smoke. And that it's log prob is invariant to
     rotation and translation."""
     key = jax.random.PRNGKey(0)
@@ -18,31 +30,32 @@ def test_base_distribution():
     batch_size = 7
     shape = (batch_size, n_nodes,  n_aux + 1, dim)
 
-    edges = list(zip(range(n_nodes - 1), range(1, n_nodes)))
-    x_dists = [CentreGravityGaussian(dim=dim, n_nodes=n_nodes),
-               HarmonicPotential(dim=dim, n_nodes=n_nodes, edges=edges),
-               AldpTransformedInternals(data_path='eacf/targets/data/aldp_500K_train_mini.h5')]
-
-    for x_dist in x_dists:
-        dist = JointBaseDistribution(dim=dim, n_nodes=n_nodes, n_aux=n_aux,
-                                     x_dist=x_dist)
+    if x_dist_type == 'centre_gravity_gaussian':
+        x_dist = CentreGravityGaussian(dim=dim, n_nodes=n_nodes)
+    elif x_dist_type == 'harmonic_potential':
+        edges = list(zip(range(n_nodes - 1), range(1, n_nodes)))
+        x_dist = HarmonicPotential(dim=dim, n_nodes=n_nodes, edges=edges)
+    else:
+        x_dist = AldpTransformedInternals(data_path=ALDP_DATA_PATH)
+    dist = JointBaseDistribution(dim=dim, n_nodes=n_nodes, n_aux=n_aux,
+                                 x_dist=x_dist)
 
-        # Sample: Test that it does not smoke.
-        sample = dist.sample(seed=key, sample_shape=batch_size)
-        chex.assert_shape(sample, shape)
-        assert_mean_zero(sample[:, :, 0], node_axis=1)
+    # Sample: Test that it does not smoke.
+    sample = dist.sample(seed=key, sample_shape=batch_size)
+    chex.assert_shape(sample, shape)
+    assert_mean_zero(sample[:, :, 0], node_axis=1)
 
-        # Log prob: Test that it is invariant to translation and rotation.
-        log_prob = dist.log_prob(sample)
-        chex.assert_shape(log_prob, (batch_size,))
-        assert_is_invariant(invariant_fn=dist.log_prob, key=key, event_shape=shape[1:])
+    # Log prob: Test that it is invariant to translation and rotation.
+    log_prob = dist.log_prob(sample)
+    chex.assert_shape(log_prob, (batch_size,))
+    assert_is_invariant(invariant_fn=dist.log_prob, key=key, event_shape=shape[1:])
 
 
-        # Single sample and log prob: Test that it does not smoke.
-        sample = dist.sample(seed=key)
-        log_prob = dist.log_prob(sample)
-        chex.assert_shape(sample, (n_nodes, n_aux + 1, dim))
-        chex.assert_shape(log_prob.shape, ())
+    # Single sample and log prob: Test that it does not smoke.
+    sample = dist.sample(seed=key)
+    log_prob = dist.log_prob(sample)
+    chex.assert_shape(sample, (n_nodes, n_aux + 1, dim))
+    chex.assert_shape(log_prob.shape, ())
 
 
 if __name__ == '__main__':
@@ -51,4 +64,5 @@ if __name__ == '__main__':
         from jax.config import config
         config.update("jax_enable_x64", True)
 
-    test_base_distribution()
+    for x_dist_type in ['centre_gravity_gaussian', 'harmonic_potential', 'aldp_transformed_internals']:
+        test_base_distribution(x_dist_type)
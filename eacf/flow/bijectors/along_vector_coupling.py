@@ -49,7 +49,6 @@ class AlongVectorSplitCoupling(BijectorWithExtra):
         self._graph_features = graph_features
         self.use_aux_loss = use_aux_loss
         self.n_inner_transforms = n_inner_transforms
-        super().__init__(event_ndims_in=event_ndims)
 
     def _split(self, x: Array) -> Tuple[Array, Array]:
         x1, x2 = jnp.split(x, [self._split_index], self._split_axis)
@@ -124,7 +123,7 @@ class AlongVectorSplitCoupling(BijectorWithExtra):
             log_det_total = log_det_total + log_det
             chex.assert_shape(log_det_total, ())
 
-        extras = jax.tree_map(lambda *xs: jnp.stack(xs), *extras)
+        extras = jax.tree_util.tree_map(lambda *xs: jnp.stack(xs), *extras)
         extras = extras._replace(aux_info=extras.aggregate_info(),
                                  aux_loss=jnp.zeros(()))
         y2 = x2
@@ -154,7 +153,7 @@ class AlongVectorSplitCoupling(BijectorWithExtra):
             log_det_total = log_det_total + log_det
             chex.assert_shape(log_det_total, ())
 
-        extras = jax.tree_map(lambda *xs: jnp.stack(xs), *extras)
+        extras = jax.tree_util.tree_map(lambda *xs: jnp.stack(xs), *extras)
         extras = extras._replace(aux_info=extras.aggregate_info(),
                                  aux_loss=jnp.zeros(()))
         x2 = y2
@@ -174,7 +173,6 @@ class AlongVectorSplitCoupling(BijectorWithExtra):
             return self.forward_and_log_det_single(x, self._graph_features)
         elif len(x.shape) == 4:
             if self._graph_features.shape[0] != x.shape[0]:
-                print("graph features has no batch size")
                 return jax.vmap(self.forward_and_log_det_single, in_axes=(0, None))(x, self._graph_features)
             else:
                 return jax.vmap(self.forward_and_log_det_single)(x, self._graph_features)
@@ -187,7 +185,6 @@ class AlongVectorSplitCoupling(BijectorWithExtra):
             return self.inverse_and_log_det_single(y, self._graph_features)
         elif len(y.shape) == 4:
             if self._graph_features.shape[0] != y.shape[0]:
-                print("graph features has no batch size")
                 return jax.vmap(self.inverse_and_log_det_single, in_axes=(0, None))(y, self._graph_features)
             else:
                 return jax.vmap(self.inverse_and_log_det_single)(y, self._graph_features)
@@ -200,7 +197,6 @@ class AlongVectorSplitCoupling(BijectorWithExtra):
             h, logdet, extra = self.forward_and_log_det_single_with_extra(x, self._graph_features)
         elif len(x.shape) == 4:
             if self._graph_features.shape[0] != x.shape[0]:
-                print("graph features has no batch size")
                 h, logdet, extra = jax.vmap(self.forward_and_log_det_single_with_extra, in_axes=(0, None))(
                     x, self._graph_features)
             else:
@@ -217,7 +213,6 @@ class AlongVectorSplitCoupling(BijectorWithExtra):
             x, logdet, extra = self.inverse_and_log_det_single_with_extra(y, self._graph_features)
         elif len(y.shape) == 4:
             if self._graph_features.shape[0] != y.shape[0]:
-                print("graph features has no batch size")
                 x, logdet, extra = jax.vmap(self.inverse_and_log_det_single_with_extra, in_axes=(0, None))(
                     y, self._graph_features)
             else:
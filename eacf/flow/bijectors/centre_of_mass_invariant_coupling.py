@@ -47,7 +47,6 @@ class CentreOfMassInvariantSplitCoupling(BijectorWithExtra):
         self._graph_features = graph_features
         self._conditioner = conditioner
         self.n_inner_transforms = n_inner_transforms
-        super().__init__(event_ndims_in=event_ndims)
 
     def adjust_centering_pre_proj(self, x: chex.Array) -> chex.Array:
         """x[:, 0, :] is constrained to ZeroMean Gaussian. But if `self._swap` is True, then we
@@ -149,7 +148,6 @@ class CentreOfMassInvariantSplitCoupling(BijectorWithExtra):
             return self.forward_and_log_det_single(x, self._graph_features)
         elif len(x.shape) == 4:
             if self._graph_features.shape[0] != x.shape[0]:
-                print("graph features has no batch size")
                 return jax.vmap(self.forward_and_log_det_single, in_axes=(0, None))(x, self._graph_features)
             else:
                 return jax.vmap(self.forward_and_log_det_single)(x, self._graph_features)
@@ -162,7 +160,6 @@ class CentreOfMassInvariantSplitCoupling(BijectorWithExtra):
             return self.inverse_and_log_det_single(y, self._graph_features)
         elif len(y.shape) == 4:
             if self._graph_features.shape[0] != y.shape[0]:
-                print("graph features has no batch size")
                 return jax.vmap(self.inverse_and_log_det_single, in_axes=(0, None))(y, self._graph_features)
             else:
                 return jax.vmap(self.inverse_and_log_det_single)(y, self._graph_features)
@@ -176,7 +173,6 @@ class CentreOfMassInvariantSplitCoupling(BijectorWithExtra):
             h, logdet, extra = self.forward_and_log_det_with_extra_single(x, self._graph_features)
         elif len(x.shape) == 4:
             if self._graph_features.shape[0] != x.shape[0]:
-                print("graph features has no batch size")
                 h, logdet, extra = jax.vmap(self.forward_and_log_det_with_extra_single, in_axes=(0, None))(
                     x, self._graph_features)
             else:
@@ -193,7 +189,6 @@ class CentreOfMassInvariantSplitCoupling(BijectorWithExtra):
             x, logdet, extra = self.inverse_and_log_det_with_extra_single(y, self._graph_features)
         elif len(y.shape) == 4:
             if self._graph_features.shape[0] != y.shape[0]:
-                print("graph features has no batch size")
                 x, logdet, extra = jax.vmap(self.inverse_and_log_det_with_extra_single, in_axes=(0, None))(
                     y, self._graph_features)
             else:
@@ -132,7 +132,6 @@ class SplitCouplingWithExtra(BijectorWithExtra):
             return self.forward_and_log_det_single(x, self._graph_features)
         elif len(x.shape) == 4:
             if self._graph_features.shape[0] != x.shape[0]:
-                print("graph features has no batch size")
                 return jax.vmap(self.forward_and_log_det_single, in_axes=(0, None))(x, self._graph_features)
             else:
                 return jax.vmap(self.forward_and_log_det_single)(x, self._graph_features)
@@ -145,7 +144,6 @@ class SplitCouplingWithExtra(BijectorWithExtra):
             return self.inverse_and_log_det_single(y, self._graph_features)
         elif len(y.shape) == 4:
             if self._graph_features.shape[0] != y.shape[0]:
-                print("graph features has no batch size")
                 return jax.vmap(self.inverse_and_log_det_single, in_axes=(0, None))(y, self._graph_features)
             else:
                 return jax.vmap(self.inverse_and_log_det_single)(y, self._graph_features)
@@ -159,7 +157,6 @@ class SplitCouplingWithExtra(BijectorWithExtra):
             h, logdet, extra = self.forward_and_log_det_with_extra_single(x, self._graph_features)
         elif len(x.shape) == 4:
             if self._graph_features.shape[0] != x.shape[0]:
-                print("graph features has no batch size")
                 h, logdet, extra = jax.vmap(self.forward_and_log_det_with_extra_single, in_axes=(0, None))(
                     x, self._graph_features)
             else:
@@ -176,7 +173,6 @@ class SplitCouplingWithExtra(BijectorWithExtra):
             x, logdet, extra = self.inverse_and_log_det_with_extra_single(y, self._graph_features)
         elif len(y.shape) == 4:
             if self._graph_features.shape[0] != y.shape[0]:
-                print("graph features has no batch size")
                 x, logdet, extra = jax.vmap(self.inverse_and_log_det_with_extra_single, in_axes=(0, None))(
                     y, self._graph_features)
             else:
@@ -4,10 +4,11 @@ import chex
 import distrax
 import jax
 import jax.numpy as jnp
+import numpy as np
 
 from eacf.utils.numerical import rotate_2d
 
-from eacf.utils.numerical import vector_rejection, safe_norm
+from eacf.utils.numerical import safe_normalize
 from eacf.flow.distrax_with_extra import BijectorWithExtra, Array, Extra
 from eacf.flow.bijectors.proj_flow_layer import ProjFlow
 
@@ -23,27 +24,28 @@ def get_equivariant_orthonormal_basis(vectors: chex.Array, add_small_identity: b
 
     if add_small_identity:
         # Add independant vectors to try help improve numerical stability
-        vectors = vectors + jnp.eye(n_vectors, dim)[None, :, :] * 1e-6
+        # Built with numpy so it is a trace-time constant rather than an eye op + multiply in the graph.
+        vectors = vectors + np.eye(n_vectors, dim, dtype=vectors.dtype)[None, :, :] * 1e-6
     # Set n_vectors to leading axis to make slicing simpler.
     basis_vectors = jnp.swapaxes(vectors, 0, 1)
 
-    z_basis_vector = basis_vectors[0]
-    z_basis_vector = z_basis_vector / safe_norm(z_basis_vector, axis=-1, keepdims=True)
     if dim == 3:
-        # Vector rejection to get second axis orthogonal to z axis.
-        x_basis_vector = basis_vectors[1]
-        x_basis_vector = x_basis_vector / safe_norm(x_basis_vector, axis=-1, keepdims=True)
-        x_basis_vector = vector_rejection(x_basis_vector, z_basis_vector)
-        x_basis_vector = x_basis_vector / safe_norm(x_basis_vector, axis=-1, keepdims=True)
+        # Normalise the z and x candidates together.
+        z_basis_vector, x_basis_vector = safe_normalize(basis_vectors[:2])
+        # Vector rejection to get second axis orthogonal to z axis (z is unit norm, so no need to divide by |z|^2).
+        x_basis_vector = x_basis_vector - jnp.sum(x_basis_vector * z_basis_vector, axis=-1,
+                                                  keepdims=True) * z_basis_vector
+        x_basis_vector = safe_normalize(x_basis_vector)
 
         # Cross product of z and x vector to get final vector.
         y_basis_vector = jnp.cross(z_basis_vector, x_basis_vector)
-        y_basis_vector = y_basis_vector / safe_norm(y_basis_vector, axis=-1, keepdims=True)
+        y_basis_vector = safe_normalize(y_basis_vector)
         change_of_basis_matrix = jnp.stack([z_basis_vector, x_basis_vector, y_basis_vector], axis=-1)
     else:
         assert dim == 2
+        z_basis_vector = safe_normalize(basis_vectors[0])
         y_basis_vector = rotate_2d(z_basis_vector, theta=jnp.pi * 0.5)
-        y_basis_vector = y_basis_vector / safe_norm(y_basis_vector, axis=-1, keepdims=True)
+        y_basis_vector = safe_normalize(y_basis_vector)
         change_of_basis_matrix = jnp.stack([z_basis_vector, y_basis_vector], axis=-1)
 
     chex.assert_shape(change_of_basis_matrix, (n_nodes, dim, dim))
@@ -90,7 +92,6 @@ class ProjSplitCoupling(BijectorWithExtra):
         self._graph_features = graph_features
         self._add_small_identity = add_small_identity
         self.n_inner_transforms = n_inner_transforms
-        super().__init__(event_ndims_in=event_ndims)
 
     def adjust_centering_pre_proj(self, x: chex.Array) -> chex.Array:
         """x[:, 0, :] is constrained to ZeroMean Gaussian. But if `self._swap` is True, then we
@@ -113,7 +114,9 @@ class ProjSplitCoupling(BijectorWithExtra):
 
 
     def _split(self, x: chex.Array) -> Tuple[chex.Array, chex.Array]:
-        x1, x2 = jnp.split(x, [self._split_index], self._split_axis)
+        # Static slices, rather than `jnp.split`, as the split index and axis are known at trace time.
+        x1 = jax.lax.slice_in_dim(x, 0, self._split_index, axis=self._split_axis)
+        x2 = jax.lax.slice_in_dim(x, self._split_index, None, axis=self._split_axis)
         chex.assert_equal_shape((x1, x2))  # Currently assume split always in the middle.
         if self._swap:
             x1, x2 = x2, x1
@@ -134,7 +137,7 @@ class ProjSplitCoupling(BijectorWithExtra):
                           change_of_basis_matrix=change_of_basis_matrix)
       return bijector
 
-    def get_basis_and_h(self, x: chex.Array, graph_features: chex.Array) ->\
+    def get_basis_and_h(self, x: chex.Array, graph_features: chex.Array, compute_extra: bool = True) ->\
             Tuple[chex.Array, chex.Array, chex.Array, Extra]:
         chex.assert_rank(x, 3)
         n_nodes, multiplicity, dim = x.shape
@@ -146,30 +149,39 @@ class ProjSplitCoupling(BijectorWithExtra):
 
         chex.assert_rank(h, 2)
         if self._origin_on_aug:
-            origin = jnp.repeat(x[:, :, None], self.n_inner_transforms, axis=2)
+            # Broadcast rather than repeat, so the copies of x are never materialised.
+            origin = jnp.broadcast_to(x[:, :, None], (n_nodes, multiplicity, self.n_inner_transforms, dim))
             vectors = vectors_out
         else:
             origin = x[:, :, None] + vectors_out[:, :, :, 0]
             vectors = vectors_out[:, :, :, 1:]
 
-        # Vmap over multiplicity.
-        change_of_basis_matrices = jax.vmap(jax.vmap(get_equivariant_orthonormal_basis, in_axes=(1, None), out_axes=1),
-        in_axes=(1, None), out_axes=1)(vectors, self._add_small_identity)
-        extra = self.get_extra(vectors)
+        # The basis is computed independently for each node, so flatten the multiplicity and transform axes into the
+        # node axis and compute all bases in one call, rather than vmapping over multiplicity and transforms.
+        change_of_basis_matrices = get_equivariant_orthonormal_basis(
+            jnp.reshape(vectors, (-1, *vectors.shape[-2:])), self._add_small_identity)
+        change_of_basis_matrices = jnp.reshape(change_of_basis_matrices,
+                                               (n_nodes, multiplicity, self.n_inner_transforms, dim, dim))
+        # The extra (aux loss and basis angle info) is skipped when the caller will discard it.
+        extra = self.get_extra(vectors) if compute_extra else Extra()
 
         chex.assert_shape(origin, (n_nodes, multiplicity, self.n_inner_transforms, dim))
         chex.assert_shape(change_of_basis_matrices, (n_nodes, multiplicity, self.n_inner_transforms, dim, dim))
         return origin, change_of_basis_matrices, h, extra
 
-    def get_vector_info_single(self, basis_vectors: chex.Array) -> Tuple[chex.Array, chex.Array, chex.Array]:
-        chex.assert_rank(basis_vectors, 2)
-        n_vectors, dim = basis_vectors.shape
+    def get_vector_info(self, basis_vectors: chex.Array) -> Tuple[chex.Array, chex.Array, chex.Array]:
+        """Angle between the first two basis vectors, batched over all leading axes."""
+        n_vectors, dim = basis_vectors.shape[-2:]
         assert dim == 3
         assert n_vectors == 2 or n_vectors == 3
-        basis_vectors = basis_vectors
-        vec1 = basis_vectors[0]
-        vec2 = basis_vectors[1]
-        arccos_in = jnp.dot(vec1, vec2) / safe_norm(vec1, axis=-1) / safe_norm(vec2, axis=-1)
+        vec1 = basis_vectors[..., 0, :]
+        vec2 = basis_vectors[..., 1, :]
+        # Cosine of the angle from three reductions over the same vectors, without normalising each vector first.
+        # Zero squared norms are mapped to 1 as in `safe_norm`.
+        vec1_sq = jnp.sum(vec1**2, axis=-1)
+        vec2_sq = jnp.sum(vec2**2, axis=-1)
+        arccos_in = jnp.sum(vec1 * vec2, axis=-1) * jax.lax.rsqrt(
+            jnp.where(vec1_sq == 0, 1, vec1_sq) * jnp.where(vec2_sq == 0, 1, vec2_sq))
         theta = jnp.arccos(arccos_in)
         log_barrier_in = 1 - jnp.abs(arccos_in)
 
@@ -183,8 +195,8 @@ class ProjSplitCoupling(BijectorWithExtra):
         if dim == 2:
             return Extra()
         else:
-            # Vmap over n_nodes, multiplicity, and n_inner_transforms.
-            theta, aux_loss, log_barrier_in = jax.vmap(jax.vmap(jax.vmap(self.get_vector_info_single)))(vectors)
+            # Batched over n_nodes, multiplicity, and n_inner_transforms.
+            theta, aux_loss, log_barrier_in = self.get_vector_info(vectors)
             info = {}
             info_aggregator = {}
             info_aggregator.update(
@@ -199,7 +211,8 @@ class ProjSplitCoupling(BijectorWithExtra):
             extra = Extra(aux_loss=aux_loss, aux_info=info, info_aggregator=info_aggregator)
             return extra
 
-    def forward_and_log_det_with_extra_single(self, x: Array, graph_features: chex.Array) -> Tuple[Array, Array, Extra]:
+    def forward_and_log_det_with_extra_single(self, x: Array, graph_features: chex.Array,
+                                              compute_extra: bool = True) -> Tuple[Array, Array, Extra]:
         """Computes y = f(x) and log|det J(f)(x)|."""
         chex.assert_rank(x, 3)
         dim = x.shape[-1]
@@ -207,7 +220,8 @@ class ProjSplitCoupling(BijectorWithExtra):
         self._check_forward_input_shape(x)
         x = self.adjust_centering_pre_proj(x)
         x1, x2 = self._split(x)
-        origins, change_of_basis_matrices, bijector_feat_in, extra = self.get_basis_and_h(x1, graph_features)
+        origins, change_of_basis_matrices, bijector_feat_in, extra = self.get_basis_and_h(
+            x1, graph_features, compute_extra)
         n_nodes, multiplicity, n_transforms, n_vectors, dim = change_of_basis_matrices.shape
         assert n_transforms == self.n_inner_transforms
 
@@ -224,7 +238,8 @@ class ProjSplitCoupling(BijectorWithExtra):
         y = self.adjust_centering_post_proj(y)
         return y, log_det_total, extra
 
-    def inverse_and_log_det_with_extra_single(self, y: Array, graph_features: chex.Array) -> Tuple[Array, Array, Extra]:
+    def inverse_and_log_det_with_extra_single(self, y: Array, graph_features: chex.Array,
+                                              compute_extra: bool = True) -> Tuple[Array, Array, Extra]:
         """Computes x = f^{-1}(y) and log|det J(f^{-1})(y)|."""
         self._check_inverse_input_shape(y)
         chex.assert_rank(y, 3)
@@ -232,7 +247,8 @@ class ProjSplitCoupling(BijectorWithExtra):
 
         y = self.adjust_centering_pre_proj(y)
         y1, y2 = self._split(y)
-        origins, change_of_basis_matrices, bijector_feat_in, extra = self.get_basis_and_h(y1, graph_features)
+        origins, change_of_basis_matrices, bijector_feat_in, extra = self.get_basis_and_h(
+            y1, graph_features, compute_extra)
         n_nodes, multiplicity, n_transforms, n_vectors, dim = change_of_basis_matrices.shape
         assert n_transforms == self.n_inner_transforms
 
@@ -250,10 +266,10 @@ class ProjSplitCoupling(BijectorWithExtra):
         return x, log_det_total, extra
 
     def forward_and_log_det_single(self, x: Array, graph_features: chex.Array) -> Tuple[Array, Array]:
-        return self.forward_and_log_det_with_extra_single(x, graph_features)[:2]
+        return self.forward_and_log_det_with_extra_single(x, graph_features, compute_extra=False)[:2]
 
     def inverse_and_log_det_single(self, y: Array, graph_features: chex.Array) -> Tuple[Array, Array]:
-        return self.inverse_and_log_det_with_extra_single(y, graph_features)[:2]
+        return self.inverse_and_log_det_with_extra_single(y, graph_features, compute_extra=False)[:2]
 
     def forward_and_log_det(self, x: Array) -> Tuple[Array, Array]:
         """Computes y = f(x) and log|det J(f)(x)|."""
@@ -261,7 +277,6 @@ class ProjSplitCoupling(BijectorWithExtra):
             return self.forward_and_log_det_single(x, self._graph_features)
         elif len(x.shape) == 4:
             if self._graph_features.shape[0] != x.shape[0]:
-                print("graph features has no batch size")
                 return jax.vmap(self.forward_and_log_det_single, in_axes=(0, None))(x, self._graph_features)
             else:
                 return jax.vmap(self.forward_and_log_det_single)(x, self._graph_features)
@@ -274,7 +289,6 @@ class ProjSplitCoupling(BijectorWithExtra):
             return self.inverse_and_log_det_single(y, self._graph_features)
         elif len(y.shape) == 4:
             if self._graph_features.shape[0] != y.shape[0]:
-                print("graph features has no batch size")
                 return jax.vmap(self.inverse_and_log_det_single, in_axes=(0, None))(y, self._graph_features)
             else:
                 return jax.vmap(self.inverse_and_log_det_single)(y, self._graph_features)
@@ -288,7 +302,6 @@ class ProjSplitCoupling(BijectorWithExtra):
             h, logdet, extra = self.forward_and_log_det_with_extra_single(x, self._graph_features)
         elif len(x.shape) == 4:
             if self._graph_features.shape[0] != x.shape[0]:
-                print("graph features has no batch size")
                 h, logdet, extra = jax.vmap(self.forward_and_log_det_with_extra_single, in_axes=(0, None))(
                     x, self._graph_features)
             else:
@@ -305,7 +318,6 @@ class ProjSplitCoupling(BijectorWithExtra):
             x, logdet, extra = self.inverse_and_log_det_with_extra_single(y, self._graph_features)
         elif len(y.shape) == 4:
             if self._graph_features.shape[0] != y.shape[0]:
-                print("graph features has no batch size")
                 x, logdet, extra = jax.vmap(self.inverse_and_log_det_with_extra_single, in_axes=(0, None))(
                     y, self._graph_features)
             else:
@@ -2,7 +2,6 @@ from typing import Tuple
 
 import chex
 import distrax
-import jax
 import jax.numpy as jnp
 
 
@@ -10,6 +9,7 @@ def project(x: chex.Array, origin: chex.Array, change_of_basis_matrix: chex.Arra
     chex.assert_rank(x, 1)
     chex.assert_rank(change_of_basis_matrix, 2)
     chex.assert_equal_shape((x, origin, change_of_basis_matrix[0], change_of_basis_matrix[:, 0]))
+    # The basis is orthonormal, so its inverse is its transpose (no matrix inversion needed).
     return change_of_basis_matrix.T @ (x - origin)
 
 def unproject(x: chex.Array, origin: chex.Array, change_of_basis_matrix: chex.Array) -> chex.Array:
@@ -32,11 +32,15 @@ class ProjFlow(distrax.Bijector):
         self.change_of_basis_matrix = change_of_basis_matrix
 
     def to_invariant_space(self, x: chex.Array) -> chex.Array:
-        x_proj = jax.vmap(jax.vmap(project))(x, self.origin, self.change_of_basis_matrix)
+        # Equivalent to `jax.vmap(jax.vmap(project))`, but as a single contraction over all leading axes.
+        chex.assert_equal_shape((x, self.origin, self.change_of_basis_matrix[..., 0]))
+        x_proj = jnp.einsum('...ji,...j->...i', self.change_of_basis_matrix, x - self.origin)
         return x_proj
 
     def to_equivariant_space(self, x_proj: chex.Array) -> chex.Array:
-        x = jax.vmap(jax.vmap(unproject))(x_proj, self.origin, self.change_of_basis_matrix)
+        # Equivalent to `jax.vmap(jax.vmap(unproject))`.
+        chex.assert_equal_shape((x_proj, self.origin, self.change_of_basis_matrix[..., 0]))
+        x = jnp.einsum('...ij,...j->...i', self.change_of_basis_matrix, x_proj) + self.origin
         return x
 
     def forward_and_log_det(self, x: chex.Array) -> Tuple[chex.Array, chex.Array]:
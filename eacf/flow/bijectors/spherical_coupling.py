@@ -52,7 +52,6 @@ class SphericalSplitCoupling(BijectorWithExtra):
         self.use_aux_loss = use_aux_loss
         self.n_inner_transforms = n_inner_transforms
         self.reflection_invariant = reflection_invariant
-        super().__init__(event_ndims_in=event_ndims)
 
     def _split(self, x: Array) -> Tuple[Array, Array]:
         x1, x2 = jnp.split(x, [self._split_index], self._split_axis)
@@ -212,7 +211,6 @@ class SphericalSplitCoupling(BijectorWithExtra):
             return self.forward_and_log_det_single(x, self._graph_features)
         elif len(x.shape) == 4:
             if self._graph_features.shape[0] != x.shape[0]:
-                print("graph features has no batch size")
                 return jax.vmap(self.forward_and_log_det_single, in_axes=(0, None))(x, self._graph_features)
             else:
                 return jax.vmap(self.forward_and_log_det_single)(x, self._graph_features)
@@ -225,7 +223,6 @@ class SphericalSplitCoupling(BijectorWithExtra):
             return self.inverse_and_log_det_single(y, self._graph_features)
         elif len(y.shape) == 4:
             if self._graph_features.shape[0] != y.shape[0]:
-                print("graph features has no batch size")
                 return jax.vmap(self.inverse_and_log_det_single, in_axes=(0, None))(y, self._graph_features)
             else:
                 return jax.vmap(self.inverse_and_log_det_single)(y, self._graph_features)
@@ -238,7 +235,6 @@ class SphericalSplitCoupling(BijectorWithExtra):
             h, logdet, extra = self.forward_and_log_det_single_with_extra(x, self._graph_features)
         elif len(x.shape) == 4:
             if self._graph_features.shape[0] != x.shape[0]:
-                print("graph features has no batch size")
                 h, logdet, extra = jax.vmap(self.forward_and_log_det_single_with_extra, in_axes=(0, None))(
                     x, self._graph_features)
             else:
@@ -255,7 +251,6 @@ class SphericalSplitCoupling(BijectorWithExtra):
             x, logdet, extra = self.inverse_and_log_det_single_with_extra(y, self._graph_features)
         elif len(y.shape) == 4:
             if self._graph_features.shape[0] != y.shape[0]:
-                print("graph features has no batch size")
                 x, logdet, extra = jax.vmap(self.inverse_and_log_det_single_with_extra, in_axes=(0, None))(
                     y, self._graph_features)
             else:
@@ -47,6 +47,7 @@ class FlowDistConfig(NamedTuple):
     type: Union[str, Sequence[str]]
     identity_init: bool = True
     compile_n_unroll: int = 1
+    remat_layers: bool = False
     scaling_layer: bool = False
     scaling_layer_conditioned: bool = True
     kwargs: dict = {}
@@ -189,5 +190,6 @@ def create_flow_recipe(config: FlowDistConfig) -> AugmentedFlowRecipe:
                                      dim_x=config.dim,
                                      n_augmented=config.n_aug,
                                      compile_n_unroll=config.compile_n_unroll,
+                                     remat_layers=config.remat_layers,
                                      )
     return definition
@@ -1,14 +1,14 @@
-from typing import NamedTuple, Callable, Sequence, Tuple
+from typing import NamedTuple, Callable, Sequence, Tuple, Optional
 
 import haiku as hk
 import jax.numpy as jnp
+import jmp
 import jax
 import e3nn_jax as e3nn
 import chex
 
 from eacf.nets.base import EquivariantForwardFunction
 from eacf.utils.graph import get_senders_and_receivers_fully_connected
-from eacf.utils.numerical import safe_norm
 from eacf.nets.stable_mlp import StableMLP
 
 class EGCL(hk.Module):
@@ -85,8 +85,11 @@ class EGCL(hk.Module):
 
         # Prepare the edge attributes.
         vectors = node_positions[receivers] - node_positions[senders]
-        lengths = safe_norm(vectors, axis=-1, keepdims=False)
-        sq_lengths = lengths ** 2
+        # Squared lengths directly from the sum of squares (with zero mapped to one, as in `safe_norm`), rather than
+        # squaring the square root.
+        sq_lengths = jnp.sum(vectors**2, axis=-1)
+        sq_lengths = jnp.where(sq_lengths == 0, 1, sq_lengths)
+        lengths = jnp.sqrt(sq_lengths)
 
         edge_feat_in = jnp.concatenate([node_features[senders], node_features[receivers], sq_lengths], axis=-1)
 
@@ -96,8 +99,8 @@ class EGCL(hk.Module):
             n_cross_vectors = n_vectors * (n_vectors - 1)
             chex.assert_shape(cross_vectors, (n_nodes, n_cross_vectors, dim))
             if self.cross_multiplicty_node_feat:
-                cross_lengths = safe_norm(cross_vectors, axis=-1, keepdims=False)
-                cross_sq_lengths = cross_lengths**2  # node features [n_nodes, n_cross_vectors]
+                cross_sq_lengths = jnp.sum(cross_vectors**2, axis=-1)  # node features [n_nodes, n_cross_vectors]
+                cross_sq_lengths = jnp.where(cross_sq_lengths == 0, 1, cross_sq_lengths)
                 edge_feat_in = jnp.concatenate([edge_feat_in, cross_sq_lengths[senders], cross_sq_lengths[receivers]],
                                                axis=-1)
 
@@ -171,10 +174,14 @@ class EGNNTorsoConfig(NamedTuple):
     variance_scaling_init: float = 0.001
     cross_multiplicty_node_feat: bool = True
     cross_multiplicity_shifts: bool = True
+    compute_dtype: Optional[str] = None  # E.g. bfloat16 to run the EGCL layers in mixed precision.
+    remat: bool = False  # Recompute each EGCL layer's activations in the backward pass to save memory.
 
     def get_EGCL_kwargs(self, i):
         kwargs = self._asdict()
         del kwargs["n_blocks"]
+        del kwargs["compute_dtype"]
+        del kwargs["remat"]
         kwargs["name"] = kwargs["name"] + f"_{i}"
         del kwargs["n_vectors_hidden_per_vec_in"]
         return kwargs
@@ -184,6 +191,17 @@ def make_egnn_torso_forward_fn(
     torso_config: EGNNTorsoConfig,
 ) -> EquivariantForwardFunction:
 
+    if torso_config.compute_dtype is not None:
+        # Params and the layer outputs stay in float32, only the computation inside each EGCL layer is done in
+        # `compute_dtype`. Haiku policies are global per class, so the policy is set on a subclass that is only used
+        # by this torso, leaving any other EGCL layers (e.g. of flows built later without a policy) in float32.
+        egcl_cls = type(EGCL.__name__, (EGCL,), {})
+        policy = jmp.Policy(param_dtype=jnp.float32, compute_dtype=jnp.dtype(torso_config.compute_dtype),
+                            output_dtype=jnp.float32)
+        hk.mixed_precision.set_policy(egcl_cls, policy)
+    else:
+        egcl_cls = EGCL
+
     def forward_fn(
         positions: chex.Array,
         node_features: chex.Array,
@@ -207,8 +225,10 @@ def make_egnn_torso_forward_fn(
 
         # Loop through torso layers.
         for i in range(torso_config.n_blocks):
-            vectors, h = EGCL(**torso_config.get_EGCL_kwargs(i)
-            )(vectors, h, senders, receivers)
+            egcl_fn = lambda vectors, h, i=i: egcl_cls(**torso_config.get_EGCL_kwargs(i))(vectors, h, senders, receivers)
+            if torso_config.remat:
+                egcl_fn = hk.remat(egcl_fn)
+            vectors, h = egcl_fn(vectors, h)
 
         chex.assert_shape(vectors, (n_nodes, vec_multiplicity_in*torso_config.n_vectors_hidden_per_vec_in, dim))
         chex.assert_shape(h, (n_nodes, torso_config.n_invariant_feat_hidden))
@@ -0,0 +1,46 @@
+import jax
+import jax.numpy as jnp
+import haiku as hk
+import chex
+
+from eacf.nets.en_gnn import make_egnn_torso_forward_fn, EGNNTorsoConfig
+from eacf.utils.graph import get_senders_and_receivers_fully_connected
+
+
+def make_torso_forward(compute_dtype=None):
+    config = EGNNTorsoConfig(
+        n_blocks=2,
+        mlp_units=(4, 4),
+        n_vectors_hidden_per_vec_in=2,
+        n_invariant_feat_hidden=5,
+        name='e3gnn_torso',
+        compute_dtype=compute_dtype)
+
+    @hk.without_apply_rng
+    @hk.transform
+    def forward(positions, features):
+        egnn_torso = make_egnn_torso_forward_fn(config)
+        senders, receivers = get_senders_and_receivers_fully_connected(positions.shape[0])
+        return egnn_torso(positions, features, senders, receivers)
+    return forward
+
+
+def test_mixed_precision_policy_is_scoped_to_torso(n_nodes: int = 5, dim: int = 3):
+    """A torso built with a `compute_dtype` should not change the precision of torsos built afterwards without one."""
+    key = jax.random.PRNGKey(0)
+    positions = jax.random.normal(key, (n_nodes, 2, dim))
+    features = jnp.ones((n_nodes, 2))
+
+    forward_f32 = make_torso_forward()
+    params = forward_f32.init(key, positions, features)
+    vectors_f32, h_f32 = forward_f32.apply(params, positions, features)
+
+    forward_bf16 = make_torso_forward(compute_dtype='bfloat16')
+    vectors_bf16, h_bf16 = forward_bf16.apply(params, positions, features)
+    chex.assert_trees_all_equal_dtypes((vectors_bf16, h_bf16), (vectors_f32, h_f32))
+    assert not jnp.allclose(h_bf16, h_f32, rtol=0., atol=1e-6)
+
+    # Building a new torso without a policy must give exactly the float32 result again.
+    forward_f32_after = make_torso_forward()
+    vectors, h = forward_f32_after.apply(params, positions, features)
+    chex.assert_trees_all_equal((vectors, h), (vectors_f32, h_f32))
@@ -4,7 +4,6 @@ import chex
 import os
 import pathlib
 import jax
-import wandb
 import jax.numpy as jnp
 from datetime import datetime
 from omegaconf import DictConfig
@@ -14,14 +13,16 @@ from fabjax.sampling import build_smc, build_blackjax_hmc, build_metropolis
 from fabjax.buffer import build_prioritised_buffer
 
 from eacf.setup_run.default_plotter_fab import make_default_plotter
-from eacf.setup_run.create_train_config import setup_logger, create_flow_config
+from eacf.setup_run.create_train_config import setup_logger, create_flow_config, setup_compilation_cache, \
+    setup_matmul_precision
 
 from eacf.train.base import eval_fn, FullGraphSample, setup_padded_reshaped_data
 from eacf.train.train import TrainConfig
 from eacf.train.eval_and_plot_fn import get_eval_and_plot_fn
 from eacf.utils.loggers import WandbLogger
 from eacf.flow.build_flow import build_flow
-from eacf.train.max_lik_train_and_eval import get_eval_on_test_batch_with_further, calculate_forward_ess
+from eacf.train.max_lik_train_and_eval import get_eval_on_test_batch_with_further, calculate_forward_ess, \
+    get_invariance_checks_on_test_batch
 from eacf.utils.optimize import get_optimizer, OptimizerConfig
 from eacf.train.fab_train_no_buffer import build_fab_no_buffer_init_step_fns, TrainStateNoBuffer
 from eacf.train.fab_train_with_buffer import build_fab_with_buffer_init_step_fns, TrainStateWithBuffer
@@ -36,6 +37,8 @@ def create_train_config(cfg: DictConfig,
                         evaluation_fn: Optional = None,
                         eval_and_plot_fn: Optional = None,
                         date_folder: bool = True) -> TrainConfig:
+    setup_compilation_cache(cfg)
+    setup_matmul_precision(cfg)
     devices = jax.devices()
     if len(devices) > 1 and cfg.training.use_multiple_devices:
         print(f"Running with pmap using {len(devices)} devices.")
@@ -74,7 +77,7 @@ def create_train_config_non_pmap(cfg: DictConfig, target_log_p_x_fn, load_datase
     else:
         save_path = training_config.pop("save_dir")
     if cfg.training.save_in_wandb_dir and isinstance(logger, WandbLogger):
-        save_path = os.path.join(wandb.run.dir, save_path)
+        save_path = os.path.join(logger.run.dir, save_path)
 
     pathlib.Path(save_path).mkdir(exist_ok=True, parents=True)
 
@@ -133,6 +136,7 @@ def create_train_config_non_pmap(cfg: DictConfig, target_log_p_x_fn, load_datase
             smc=smc, optimizer=optimizer,
             batch_size=cfg.training.batch_size,
             n_updates_per_smc_forward_pass=cfg.fab.n_updates_per_smc_forward_pass,
+            n_unroll_gradient_updates=cfg.fab.get('n_unroll_gradient_updates', 1),
             buffer=buffer,
             use_aux_loss=cfg.training.use_flow_aux_loss,
             aux_loss_weight=cfg.training.aux_loss_weight,
@@ -149,8 +153,9 @@ def create_train_config_non_pmap(cfg: DictConfig, target_log_p_x_fn, load_datase
     if evaluation_fn is None and eval_and_plot_fn is None:
         # Setup eval functions
         eval_on_test_batch_fn = partial(get_eval_on_test_batch_with_further,
-                                        flow=flow, K=cfg.training.K_marginal_log_lik, test_invariances=True,
+                                        flow=flow, K=cfg.training.K_marginal_log_lik, test_invariances=False,
                                         target_log_prob=target_log_p_x_fn)
+        eval_on_first_test_batch_fn = partial(get_invariance_checks_on_test_batch, flow=flow)
 
         # AIS with p as the target_energy. Note that step size params will have been tuned for alpha=2.
         smc_eval = build_smc(transition_operator=transition_operator,
@@ -161,6 +166,7 @@ def create_train_config_non_pmap(cfg: DictConfig, target_log_p_x_fn, load_datase
         def evaluation_fn(state: Union[TrainStateNoBuffer, TrainStateWithBuffer], key: chex.PRNGKey) -> dict:
             eval_info, log_w_test_data, flat_mask = eval_fn(test_data, key, state.params,
                     eval_on_test_batch_fn=eval_on_test_batch_fn,
+                    eval_on_first_test_batch_fn=eval_on_first_test_batch_fn,
                     eval_batch_free_fn=None,
                     batch_size=cfg.training.eval_batch_size)
             further_info = calculate_forward_ess(log_w_test_data, flat_mask)
@@ -227,7 +233,7 @@ def create_train_config_pmap(cfg: DictConfig, target_log_p_x_fn, load_dataset, d
     else:
         save_path = training_config.pop("save_dir")
     if cfg.training.save_in_wandb_dir and isinstance(logger, WandbLogger):
-        save_path = os.path.join(wandb.run.dir, save_path)
+        save_path = os.path.join(logger.run.dir, save_path)
 
     pathlib.Path(save_path).mkdir(exist_ok=True, parents=True)
 
@@ -286,6 +292,7 @@ def create_train_config_pmap(cfg: DictConfig, target_log_p_x_fn, load_dataset, d
             smc=smc, optimizer=optimizer,
             batch_size=cfg.training.batch_size,
             n_updates_per_smc_forward_pass=cfg.fab.n_updates_per_smc_forward_pass,
+            n_unroll_gradient_updates=cfg.fab.get('n_unroll_gradient_updates', 1),
             buffer=buffer,
             equivariance_regularisation=data_augmentation,
             use_aux_loss=cfg.training.use_flow_aux_loss,
@@ -301,21 +308,26 @@ def create_train_config_pmap(cfg: DictConfig, target_log_p_x_fn, load_dataset, d
         common_keys = jnp.repeat(common_key[None, ...], n_devices, axis=0)
         per_device_keys = jax.random.split(per_device_key, n_devices)
         init_state = jax.pmap(init_single_device_fn)(common_keys, per_device_keys)
-        # Run check to ensure params are synched.
-        chex.assert_trees_all_equal(jax.tree_map(lambda x: x[0], init_state.params),
-                                    jax.tree_map(lambda x: x[1], init_state.params))
-        assert (init_state.key[0] != init_state.key[1]).all()  # Check rng per state is different.
+        if cfg.training.get('debug', False):
+            # Run check to ensure params are synched. Skipped otherwise as it pulls all params to the host.
+            chex.assert_trees_all_equal(jax.tree_util.tree_map(lambda x: x[0], init_state.params),
+                                        jax.tree_util.tree_map(lambda x: x[1], init_state.params))
+            assert (init_state.key[0] != init_state.key[1]).all()  # Check rng per state is different.
         return init_state
 
+    # The state (including the buffer) is donated as it is replaced by the output state.
+    update_fn_pmap = jax.pmap(update_single_device_fn, axis_name=pmap_axis_name, donate_argnums=(0,))
+
     def update_fn(state: TrainStateWithBuffer) -> Tuple[TrainStateWithBuffer, dict]:
-        state, info = jax.pmap(update_single_device_fn, axis_name=pmap_axis_name)(state)
+        state, info = update_fn_pmap(state)
         return state, get_from_first_device(info, as_numpy=False)
 
     if evaluation_fn is None and eval_and_plot_fn is None:
         # Setup eval functions
         eval_on_test_batch_fn = partial(get_eval_on_test_batch_with_further,
-                                        flow=flow, K=cfg.training.K_marginal_log_lik, test_invariances=True,
+                                        flow=flow, K=cfg.training.K_marginal_log_lik, test_invariances=False,
                                         target_log_prob=target_log_p_x_fn)
+        eval_on_first_test_batch_fn = partial(get_invariance_checks_on_test_batch, flow=flow)
 
         # AIS with p as the target_energy. Note that step size params will have been tuned for alpha=2.
         smc_eval = build_smc(transition_operator=transition_operator,
@@ -327,6 +339,7 @@ def create_train_config_pmap(cfg: DictConfig, target_log_p_x_fn, load_dataset, d
                 Tuple[dict, chex.Array, chex.Array]:
             eval_info, log_w_test, flat_mask = eval_fn(x_test, key, state.params,
                                 eval_on_test_batch_fn=eval_on_test_batch_fn,
+                                eval_on_first_test_batch_fn=eval_on_first_test_batch_fn,
                                 eval_batch_free_fn=None,
                                 batch_size=cfg.training.eval_batch_size,
                                 mask=test_mask)
@@ -342,12 +355,15 @@ def create_train_config_pmap(cfg: DictConfig, target_log_p_x_fn, load_dataset, d
             eval_info = jax.lax.pmean(eval_info, axis_name=pmap_axis_name)
             return eval_info, log_w_test, flat_mask
 
-        test_data_per_device, test_mask = setup_padded_reshaped_data(test_data, n_devices)
+        # Pad, reshape and place each device's shard of the test data once, rather than on every evaluation.
+        test_data_per_device, test_mask = jax.tree_util.tree_map(
+            lambda x: jax.device_put_sharded(list(x), devices),
+            setup_padded_reshaped_data(jax.device_get(test_data), n_devices))
+        evaluation_fn_pmap = jax.pmap(evaluation_fn_single_device, axis_name=pmap_axis_name)
 
         def evaluation_fn(state: TrainStateWithBuffer, key: chex.PRNGKey) -> dict:
             keys = jax.random.split(key, n_devices)
-            info, log_w_test, mask = jax.pmap(evaluation_fn_single_device, axis_name=pmap_axis_name)(
-                state, keys, test_data_per_device, test_mask)
+            info, log_w_test, mask = evaluation_fn_pmap(state, keys, test_data_per_device, test_mask)
             info = get_from_first_device(info, as_numpy=True)
             further_info = calculate_forward_ess(log_w_test.flatten(), mask=mask.flatten())
             info.update(further_info)
@@ -2,21 +2,22 @@ from typing import Tuple, Optional
 
 import chex
 import jax
-import wandb
-import matplotlib.pyplot as plt
 import os
 import pathlib
-import haiku as hk
 from datetime import datetime
 from omegaconf import DictConfig
 import matplotlib as mpl
 from functools import partial
 import jax.numpy as jnp
+import numpy as np
+import optax
+from jax.experimental.shard_map import shard_map
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
 
 from eacf.setup_run.default_plotter import make_default_plotter
 from eacf.setup_run.configs import TrainingState
 
-from eacf.train.base import get_shuffle_and_batchify_data_fn, create_scan_epoch_fn, eval_fn, \
+from eacf.train.base import get_shuffle_and_batchify_data_fn, create_scan_epoch_fn, create_scan_fn, eval_fn, \
     setup_padded_reshaped_data
 from eacf.train.custom_step import training_step, training_step_with_masking
 from eacf.train.train import TrainConfig
@@ -26,33 +27,13 @@ from eacf.flow.build_flow import build_flow, FlowDistConfig, ConditionalAuxDistC
 from eacf.flow.aug_flow_dist import FullGraphSample, AugmentedFlow, AugmentedFlowParams
 from eacf.nets.make_egnn import NetsConfig, MLPHeadConfig, EGNNTorsoConfig, TransformerConfig
 from eacf.train.max_lik_train_and_eval import general_ml_loss_fn, get_eval_on_test_batch, eval_non_batched, \
-    masked_ml_loss_fn, get_eval_on_test_batch_with_further, calculate_forward_ess
+    masked_ml_loss_fn, get_eval_on_test_batch_with_further, calculate_forward_ess, get_invariance_checks_on_test_batch
 from eacf.utils.loggers import Logger, WandbLogger, ListLogger, PandasLogger
-from eacf.utils.optimize import get_optimizer, OptimizerConfig
-from eacf.utils.pmap import get_from_first_device
+from eacf.utils.optimize import get_optimizer, OptimizerConfig, pmean_gradients
+from eacf.utils.pmap import get_from_first_device, get_from_first_shard
 
 mpl.rcParams['figure.dpi'] = 150
 
-def plot_and_maybe_save(plotter,
-                        params: AugmentedFlowParams,
-                        flow: AugmentedFlow,
-                        key: chex.PRNGKey,
-                        plot_batch_size: int,
-                        train_data: FullGraphSample,
-                        test_data: FullGraphSample,
-                        epoch_n: int,
-                        save: bool,
-                        plots_dir: str
-                        ):
-    figures = plotter(params, flow, key, plot_batch_size, train_data, test_data)
-    for j, figure in enumerate(figures):
-        if save:
-            figure.savefig(os.path.join(plots_dir, f"{j}_iter_{epoch_n}.png"))
-        else:
-            plt.show()
-        plt.close(figure)
-
-
 def setup_logger(cfg: DictConfig) -> Logger:
     if hasattr(cfg.logger, "wandb"):
         logger = WandbLogger(**cfg.logger.wandb, config=dict(cfg))
@@ -101,15 +82,38 @@ def create_flow_config(cfg: DictConfig):
     )
     return flow_dist_config
 
+def setup_compilation_cache(cfg: DictConfig) -> None:
+    """Persist compiled XLA executables to disk, so that restarted runs skip recompiling the init, training and
+    eval functions."""
+    cache_dir = cfg.training.get('compilation_cache_dir', None)
+    if cache_dir in [None, 'None']:
+        return
+    jax.config.update('jax_compilation_cache_dir', os.path.expanduser(cache_dir))
+    # Cache every executable, by default small or quick to compile ones are skipped.
+    jax.config.update('jax_persistent_cache_min_entry_size_bytes', 0)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
+
+
+def setup_matmul_precision(cfg: DictConfig) -> None:
+    """Set the default precision of float32 matmuls and convolutions in the flow, e.g. `tensorfloat32` to use the
+    TF32 tensor cores on Ampere and newer GPUs. Has no effect on float64 computation."""
+    precision = cfg.training.get('matmul_precision', None)
+    if precision in [None, 'None']:
+        return
+    jax.config.update('jax_default_matmul_precision', precision)
+
+
 def create_train_config(cfg: DictConfig, load_dataset, dim, n_nodes,
                         plotter: Optional = None,
                         evaluation_fn: Optional = None,
                         eval_and_plot_fn: Optional = None,
                         date_folder: bool = True,
                         target_log_prob_fn: Optional = None) -> TrainConfig:
+    setup_compilation_cache(cfg)
+    setup_matmul_precision(cfg)
     devices = jax.devices()
     if len(devices) > 1 and cfg.training.use_multiple_devices:
-        print(f"Running with pmap using {len(devices)} devices.")
+        print(f"Running data parallel over {len(devices)} devices.")
         return create_train_config_pmap(cfg, load_dataset, dim, n_nodes, plotter, evaluation_fn, eval_and_plot_fn,
                                         date_folder, target_log_prob_fn)
     else:
@@ -136,7 +140,7 @@ def create_train_config_non_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
     else:
         save_path = training_config.pop("save_dir")
     if isinstance(logger, WandbLogger) and cfg.training.save_in_wandb_dir:
-        save_path = os.path.join(wandb.run.dir, save_path)
+        save_path = os.path.join(logger.run.dir, save_path)
 
     pathlib.Path(save_path).mkdir(exist_ok=True, parents=True)
 
@@ -185,7 +189,7 @@ def create_train_config_non_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
                           apply_random_rotation=data_augmentation)
         training_step_fn = partial(training_step_with_masking, optimizer=optimizer,
                                    loss_fn_with_mask=loss_fn_with_mask,
-                                   verbose_info=cfg.training.verbose_info)
+                                   verbose_info=cfg.training.verbose_info, lr=lr)
     else:
         loss_fn = partial(general_ml_loss_fn,
                           flow=flow,
@@ -193,7 +197,7 @@ def create_train_config_non_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
                           aux_loss_weight=cfg.training.aux_loss_weight,
                           apply_random_rotation=data_augmentation)
         training_step_fn = partial(training_step, optimizer=optimizer, loss_fn=loss_fn,
-                                   verbose_info=cfg.training.verbose_info)
+                                   verbose_info=cfg.training.verbose_info, lr=lr)
 
     if cfg.training.use_scan:
         scan_epoch_fn = create_scan_epoch_fn(training_step_fn,
@@ -201,8 +205,14 @@ def create_train_config_non_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
                                              last_iter_info_only=cfg.training.last_iter_info_only,
                                              batch_size=batch_size)
     else:
-        # pass
-        training_step_fn = jax.jit(training_step_fn)
+        # Fuse `n_jitted_steps` updates into a single XLA launch to avoid paying dispatch latency every step.
+        n_jitted_steps = cfg.training.get('n_jitted_steps', 1)
+        scan_fn = create_scan_fn(training_step_fn, last_iter_info_only=False)
+
+        @partial(jax.jit, donate_argnums=(0, 1))
+        def multi_step_fn(params, opt_state, key, batched_data):
+            (params, opt_state, key), info = jax.lax.scan(scan_fn, (params, opt_state, key), batched_data)
+            return params, opt_state, key, jax.tree_util.tree_map(lambda x: x[-1], info)
 
     def init_fn(key: chex.PRNGKey) -> TrainingState:
         key1, key2 = jax.random.split(key)
@@ -219,10 +229,16 @@ def create_train_config_non_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
             opt_state = state.opt_state
             key, subkey = jax.random.split(state.key)
             batched_data = batchify_data(subkey)
-            for i in range(batched_data.positions.shape[0]):
-                x = batched_data[i]
-                key, subkey = jax.random.split(key)
-                params, opt_state, info = training_step_fn(params, x, opt_state, subkey)
+            n_steps = batched_data.positions.shape[0]
+            n_outer = n_steps // n_jitted_steps
+            n_fused = n_outer * n_jitted_steps
+            # Reshape to [n_outer, n_jitted_steps, batch_size, ...], leftover steps are run as a final shorter scan.
+            fused_data = jax.tree_util.tree_map(lambda x: jnp.reshape(x[:n_fused], (n_outer, n_jitted_steps, *x.shape[1:])),
+                                      batched_data)
+            for i in range(n_outer):
+                params, opt_state, key, info = multi_step_fn(params, opt_state, key, fused_data[i])
+            if n_fused < n_steps:
+                params, opt_state, key, info = multi_step_fn(params, opt_state, key, batched_data[n_fused:])
         return TrainingState(params, opt_state, key), info
 
     if evaluation_fn is None and eval_and_plot_fn is None:
@@ -230,7 +246,7 @@ def create_train_config_non_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
         if target_log_prob_fn:
             eval_on_test_batch_fn = partial(get_eval_on_test_batch_with_further,
                                             flow=flow, K=cfg.training.K_marginal_log_lik,
-                                            test_invariances=True,
+                                            test_invariances=False,
                                             target_log_prob=target_log_prob_fn)
             eval_batch_free_fn = partial(
                                     eval_non_batched,
@@ -241,13 +257,15 @@ def create_train_config_non_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
                                     target_log_prob=target_log_prob_fn)
         else:
             eval_on_test_batch_fn = partial(get_eval_on_test_batch,
-                                            flow=flow, K=cfg.training.K_marginal_log_lik, test_invariances=True)
+                                            flow=flow, K=cfg.training.K_marginal_log_lik, test_invariances=False)
             eval_batch_free_fn = None
+        eval_on_first_test_batch_fn = partial(get_invariance_checks_on_test_batch, flow=flow)
 
         @jax.jit
-        def evaluation_fn(state: TrainingState, key: chex.PRNGKey) -> dict:
+        def evaluation_fn_with_data(state: TrainingState, key: chex.PRNGKey, test_data: FullGraphSample) -> dict:
             eval_info, log_w_test_data, flat_mask = eval_fn(test_data, key, state.params,
                                                             eval_on_test_batch_fn=eval_on_test_batch_fn,
+                                                            eval_on_first_test_batch_fn=eval_on_first_test_batch_fn,
                                                             eval_batch_free_fn=eval_batch_free_fn,
                                                             batch_size=cfg.training.eval_batch_size)
             if target_log_prob_fn is not None:
@@ -255,6 +273,9 @@ def create_train_config_non_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
                 eval_info.update(further_info)
             return eval_info
 
+        def evaluation_fn(state: TrainingState, key: chex.PRNGKey) -> dict:
+            return evaluation_fn_with_data(state, key, test_data)
+
     if eval_and_plot_fn is None and (plotter is not None or evaluation_fn is not None):
         eval_and_plot_fn = get_eval_and_plot_fn(evaluation_fn, plotter)
 
@@ -299,7 +320,7 @@ def create_train_config_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
     else:
         save_path = training_config.pop("save_dir")
     if isinstance(logger, WandbLogger) and cfg.training.save_in_wandb_dir:
-        save_path = os.path.join(wandb.run.dir, save_path)
+        save_path = os.path.join(logger.run.dir, save_path)
 
     pathlib.Path(save_path).mkdir(exist_ok=True, parents=True)
 
@@ -314,13 +335,20 @@ def create_train_config_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
         n_epoch = n_epoch * cfg.training.factor_to_train_non_eq_flow
 
     opt_cfg = dict(training_config.pop("optimizer"))
-    n_iter_per_epoch = train_data.positions.shape[0] // (cfg.training.batch_size * n_devices)
+    grad_accum_steps = cfg.training.get('grad_accum_steps', 1)
+    # The optimizer (and its schedule) only steps once every `grad_accum_steps` minibatches.
+    n_iter_per_epoch = train_data.positions.shape[0] // (cfg.training.batch_size * n_devices) // grad_accum_steps
     n_iter_warmup = opt_cfg.pop('warmup_n_epoch')*n_iter_per_epoch
     n_iter_total = n_epoch * n_iter_per_epoch
     optimizer_config = OptimizerConfig(**opt_cfg,
                                        n_iter_total=n_iter_total,
                                        n_iter_warmup=n_iter_warmup)
     optimizer, lr = get_optimizer(optimizer_config)
+    if grad_accum_steps > 1:
+        # Accumulate gradients locally and only all-reduce them when they are applied, which cuts the communication
+        # between devices by a factor of `grad_accum_steps`.
+        optimizer = optax.MultiSteps(optax.chain(pmean_gradients(pmap_axis_name), optimizer),
+                                     every_k_schedule=grad_accum_steps).gradient_transformation()
 
 
     if plotter is None and eval_and_plot_fn is None:
@@ -338,8 +366,8 @@ def create_train_config_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
                       flow=flow,
                       use_flow_aux_loss=cfg.training.use_flow_aux_loss,
                       aux_loss_weight=cfg.training.aux_loss_weight)
-    training_step_fn = partial(training_step, optimizer=optimizer, loss_fn=loss_fn, use_pmap=True,
-                               pmap_axis_name=pmap_axis_name)
+    training_step_fn = partial(training_step, optimizer=optimizer, loss_fn=loss_fn, use_pmap=grad_accum_steps == 1,
+                               pmap_axis_name=pmap_axis_name, lr=lr)
 
 
     def init_fn_single_devices(common_key: chex.PRNGKey, per_device_key: chex.PRNGKey) -> TrainingState:
@@ -350,34 +378,86 @@ def create_train_config_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
 
     def init_fn(key: chex.PRNGKey) -> TrainingState:
         common_key, per_device_key = jax.random.split(key)
-        common_keys = jnp.repeat(common_key[None, ...], n_devices, axis=0)
-        per_device_keys = jax.random.split(per_device_key, n_devices)
+        # Place the keys on each device directly, rather than building them on the default device for pmap to scatter.
+        common_keys = jax.device_put_replicated(common_key, devices)
+        per_device_keys = jax.device_put_sharded(list(jax.random.split(per_device_key, n_devices)), devices)
         init_state = jax.pmap(init_fn_single_devices)(common_keys, per_device_keys)
-        # Run check to ensure params are synched.
-        chex.assert_trees_all_equal(jax.tree_map(lambda x: x[0], init_state.params),
-                                    jax.tree_map(lambda x: x[1], init_state.params))
-        assert (init_state.key[0] != init_state.key[1]).all()  # Check rng per state is different.
+        if cfg.training.get('debug', False):
+            # Run check to ensure params are synched. Skipped otherwise as it pulls all params to the host.
+            chex.assert_trees_all_equal(jax.tree_util.tree_map(lambda x: x[0], init_state.params),
+                                        jax.tree_util.tree_map(lambda x: x[1], init_state.params))
+            assert (init_state.key[0] != init_state.key[1]).all()  # Check rng per state is different.
         return init_state
 
-    data_rng_key_generator = hk.PRNGSequence(cfg.training.seed)
+    # Separate key for the data shuffling to avoid grabbing from the state. Each epoch's key is folded in from an
+    # on-device epoch counter, so the shuffle keys never have to be generated on, or transferred from, the host.
+    data_shuffle_base_key = jax.random.PRNGKey(cfg.training.seed)
+    data_epoch_counter = jnp.zeros((), dtype=jnp.uint32)
 
     def step_function(state: TrainingState, x: chex.ArrayTree) -> Tuple[TrainingState, dict]:
         key, subkey = jax.random.split(state.key)
         params, opt_state, info = training_step_fn(state.params, x, state.opt_state, subkey)
         return TrainingState(params=params, opt_state=opt_state, key=key), info
 
+    def scan_fn(state: TrainingState, x: chex.ArrayTree) -> Tuple[TrainingState, Optional[dict]]:
+        state, info = step_function(state, x)
+        if cfg.training.last_iter_info_only:
+            info = None
+        return state, info
+
+    def device_epoch(state: TrainingState, xs: chex.ArrayTree) -> Tuple[TrainingState, dict]:
+        """Run all of a device's steps for the epoch as a single fused computation."""
+        if cfg.training.last_iter_info_only:
+            # Only the final step's info is kept, so don't stack the info of every step.
+            final_x = xs[-1]
+            xs = xs[:-1]
+        state, info = jax.lax.scan(scan_fn, state, xs)
+        if cfg.training.last_iter_info_only:
+            state, info = step_function(state, final_x)
+        return state, info
+
+    def sharded_device_epoch(state: TrainingState, xs: chex.ArrayTree) -> Tuple[TrainingState, dict]:
+        # Each device sees a leading axis of size 1, which keeps the state laid out as [n_devices, ...].
+        state, xs = jax.tree_util.tree_map(lambda x: jnp.squeeze(x, axis=0), (state, xs))
+        state, info = device_epoch(state, xs)
+        return jax.tree_util.tree_map(lambda x: x[None], (state, info))
+
+    # Create the data parallel epoch once. The state is donated as it is replaced by the output state.
+    mesh = Mesh(np.array(devices), (pmap_axis_name,))
+    data_sharding = NamedSharding(mesh, P(pmap_axis_name))
+    # Explicit shardings at the jit boundary, so the state and data are never silently resharded between epochs.
+    sharded_epoch_fn = jax.jit(shard_map(sharded_device_epoch, mesh=mesh,
+                                         in_specs=(P(pmap_axis_name), P(pmap_axis_name)),
+                                         out_specs=(P(pmap_axis_name), P(pmap_axis_name)), check_rep=False),
+                               in_shardings=data_sharding, out_shardings=data_sharding,
+                               donate_argnums=(0,))
+
+    # Keep the train data resident (replicated) on every device across epochs, so each epoch's shuffle happens on
+    # device rather than transferring the dataset from the host.
+    replicated_sharding = NamedSharding(mesh, P())
+    train_data_on_devices = jax.device_put(train_data, replicated_sharding)
+
+    @partial(jax.jit, out_shardings=(data_sharding, replicated_sharding))
+    def get_epoch_data(data: FullGraphSample, epoch_counter: chex.Array) -> Tuple[chex.ArrayTree, chex.Array]:
+        """Shuffle, batch and reshape the epoch's data to [n_devices, n_steps, batch_size] in a single launch, laid
+        out with each device's shard of the data already in place."""
+        data_shuffle_key = jax.random.fold_in(data_shuffle_base_key, epoch_counter)
+        batchify_data = get_shuffle_and_batchify_data_fn(data, cfg.training.batch_size * n_devices)
+        batched_data = batchify_data(data_shuffle_key)
+        batched_data = jax.tree_util.tree_map(lambda x: jnp.swapaxes(jnp.reshape(
+            x, (x.shape[0], n_devices, cfg.training.batch_size, *x.shape[2:])), 0, 1), batched_data)
+        return batched_data, epoch_counter + 1
 
     def update_fn(state: TrainingState) -> Tuple[TrainingState, dict]:
-        batchify_data = get_shuffle_and_batchify_data_fn(train_data, cfg.training.batch_size * n_devices)
-        data_shuffle_key = next(data_rng_key_generator)  # Use separate key gen to avoid grabbing from state.
-        batched_data = batchify_data(data_shuffle_key)
+        nonlocal data_epoch_counter
+        batched_data, data_epoch_counter = get_epoch_data(train_data_on_devices, data_epoch_counter)
 
-        for i in range(batched_data.positions.shape[0]):
-            x = batched_data[i]
-            # Reshape to [n_devices, batch_size]
-            x = jax.tree_map(lambda x: jnp.reshape(x, (n_devices, cfg.training.batch_size, *x.shape[1:])), x)
-            state, info = jax.pmap(step_function, axis_name=pmap_axis_name)(state, x)
-        return state, get_from_first_device(info, as_numpy=False)
+        # This is a no-op once the state is on the mesh, and moves a state from `init_fn` or a resumed checkpoint,
+        # which is pmap sharded, onto the mesh.
+        state = jax.device_put(state, data_sharding)
+        state, info = sharded_epoch_fn(state, batched_data)
+        # Single host fetch of the info for the whole epoch.
+        return state, get_from_first_shard(info)
 
     if eval_and_plot_fn is not None:
         print("Running evaluation on 1 device only.")
@@ -393,7 +473,7 @@ def create_train_config_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
             if target_log_prob_fn:
                 eval_on_test_batch_fn = partial(get_eval_on_test_batch_with_further,
                                                 flow=flow, K=cfg.training.K_marginal_log_lik,
-                                                test_invariances=True,
+                                                test_invariances=False,
                                                 target_log_prob=target_log_prob_fn)
                 eval_batch_free_fn = partial(
                     eval_non_batched,
@@ -405,26 +485,31 @@ def create_train_config_pmap(cfg: DictConfig, load_dataset, dim, n_nodes,
             else:
                 eval_on_test_batch_fn = partial(get_eval_on_test_batch,
                                                 flow=flow, K=cfg.training.K_marginal_log_lik,
-                                                test_invariances=True)
+                                                test_invariances=False)
                 eval_batch_free_fn = None
+            eval_on_first_test_batch_fn = partial(get_invariance_checks_on_test_batch, flow=flow)
 
             def evaluation_fn_single_device(state: TrainingState, key: chex.PRNGKey,
                                             x_test: FullGraphSample, test_mask: chex.Array) -> \
                     Tuple[dict, chex.Array, chex.Array]:
                 eval_info, log_w_test, flat_mask = eval_fn(x_test, key, state.params,
                                     eval_on_test_batch_fn=eval_on_test_batch_fn,
+                                    eval_on_first_test_batch_fn=eval_on_first_test_batch_fn,
                                     eval_batch_free_fn=eval_batch_free_fn,
                                     batch_size=cfg.training.eval_batch_size,
                                     mask=test_mask)
                 eval_info = jax.lax.pmean(eval_info, axis_name=pmap_axis_name)
                 return eval_info, log_w_test, flat_mask
 
-            test_data_per_device, test_mask = setup_padded_reshaped_data(test_data, n_devices)
+            # Pad, reshape and place each device's shard of the test data once, rather than on every evaluation.
+            test_data_per_device, test_mask = jax.tree_util.tree_map(
+                lambda x: jax.device_put_sharded(list(x), devices),
+                setup_padded_reshaped_data(jax.device_get(test_data), n_devices))
+            evaluation_fn_pmap = jax.pmap(evaluation_fn_single_device, axis_name=pmap_axis_name)
 
             def evaluation_fn(state: TrainingState, key: chex.PRNGKey) -> dict:
                 keys = jax.random.split(key, n_devices)
-                info, log_w_test, mask = jax.pmap(evaluation_fn_single_device, axis_name=pmap_axis_name)(
-                    state, keys, test_data_per_device, test_mask)
+                info, log_w_test, mask = evaluation_fn_pmap(state, keys, test_data_per_device, test_mask)
                 if target_log_prob_fn is not None:
                     further_info = calculate_forward_ess(log_w_test.flatten(), mask=mask.flatten())
                     info.update(further_info)
@@ -32,8 +32,9 @@ def make_default_plotter(
         plotting_n_nodes: Optional[int] = None,
         max_distance: Optional[float] = 20.,
 ):
-    bins_x, count_list = bin_samples_by_dist([train_data.positions[:max_n_samples],
-                                              test_data.positions[:max_n_samples]], max_distance=max_distance)
+    bins_x, count_list = jax.device_get(bin_samples_by_dist([train_data.positions[:max_n_samples],
+                                                             test_data.positions[:max_n_samples]],
+                                                            max_distance=max_distance))
     n_samples = n_samples_from_flow
 
     @partial(jax.jit)
@@ -60,7 +61,9 @@ def make_default_plotter(
     def default_plotter(state: TrainingState, key: chex.PRNGKey) -> dict:
         # Plot interatomic distance histograms.
         key = jax.random.PRNGKey(0)
-        counts_flow_x, bins_a, count_list_a, bins_a_minus_x, count_list_a_minus_x = get_data_for_plotting(state, key)
+        # Fetch all the histograms to the host in one transfer, rather than one per matplotlib call.
+        counts_flow_x, bins_a, count_list_a, bins_a_minus_x, count_list_a_minus_x = \
+            jax.device_get(get_data_for_plotting(state, key))
 
         # Plot original coords
         fig1, axs = plt.subplots(1, 2, figsize=(10, 5))
@@ -142,19 +142,24 @@ def load_aldp(
 
     for i in range(3):
         if paths[i] is not None:
-            traj = mdtraj.load(paths[i])
+            if n_points[i] is not None:
+                # Only read the frames that are needed, rather than loading the full trajectory.
+                traj = next(mdtraj.iterload(paths[i], chunk=n_points[i]))
+            else:
+                traj = mdtraj.load(paths[i])
             # if atom_type_encoding_only:
             #     atom_encodings = {"carbon": 0, "hydrogen": 1, "oxygen": 2, "nitrogen": 3}
             #     features = jnp.array([atom_encodings[atom.element.name] for atom in traj.topology._atoms],
             #                          dtype=int)[:, None]
             # else:
-            features = jnp.arange(traj.n_atoms, dtype=int)[:, None]
+            features = np.arange(traj.n_atoms, dtype=int)[:, None]
             positions = traj.xyz
             if n_points[i] is not None:
                 positions = positions[: n_points[i]]
             datasets[i] = FullGraphSample(
                 positions=positions,
-                features=jnp.repeat(features[None, :], positions.shape[0], axis=0),
+                # Zero-copy view, the features are identical for every frame.
+                features=np.broadcast_to(features[None, :], (positions.shape[0], *features.shape)),
             )
     return tuple(datasets)
 
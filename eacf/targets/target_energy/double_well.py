@@ -4,7 +4,6 @@ import jax
 import chex
 from functools import partial
 
-from eacf.utils.graph import get_senders_and_receivers_fully_connected
 from eacf.utils.numerical import safe_norm
 from eacf.utils.mcmc import get_samples_simple
 
@@ -12,22 +11,22 @@ def energy(x, a = 0.0, b = -4., c = 0.9, d0 = 4.0, tau = 1.0):
     """Compute energy. Default hyper-parameters from https://arxiv.org/pdf/2006.02425.pdf.
     If we want to add conditioning info we could condition on the parameters a,b,c,d,tau. """
     n_nodes, dim = x.shape
-    senders, receivers = get_senders_and_receivers_fully_connected(n_nodes)
+    # The pair energy is symmetric, so sum over each unordered pair once (i < j) rather than over both directed
+    # edges and halving. Diagonal pairs are excluded, and `safe_norm` keeps the gradient finite for coincident nodes.
+    senders, receivers = np.triu_indices(n_nodes, k=1)
     vectors = x[senders] - x[receivers]
     differences = safe_norm(vectors, axis=-1)
     diff_minus_d0 = differences - d0
-    energy = jnp.sum(a * diff_minus_d0 + b * diff_minus_d0 ** 2 + c * diff_minus_d0 ** 4, axis=0) / tau / 2
+    energy = jnp.sum(a * diff_minus_d0 + b * diff_minus_d0 ** 2 + c * diff_minus_d0 ** 4, axis=0) / tau
     chex.assert_shape(energy, ())
     return energy
 
 
 def log_prob_fn(x: chex.Array, temperature=1.0):
-    if len(x.shape) == 2:
-        return - energy(x, tau=temperature)
-    elif len(x.shape) == 3:
-        return - jax.vmap(partial(energy, tau=temperature))(x)
-    else:
-        raise Exception
+    # Flatten any leading batch axes (including none) so the energy is always evaluated with a single vmap.
+    batch_shape = x.shape[:-2]
+    energies = jax.vmap(partial(energy, tau=temperature))(jnp.reshape(x, (-1, *x.shape[-2:])))
+    return - jnp.reshape(energies, batch_shape)
 
 
 def make_dataset(seed: int = 0, n_vertices=4, dim=2, n_samples: int = 10000, temperature: float = -1.,
@@ -46,9 +45,13 @@ def make_dataset(seed: int = 0, n_vertices=4, dim=2, n_samples: int = 10000, tem
 
 def plot_sample_hist(samples, ax = None, dims=(0,1)):
     if ax == None:
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
-    d = jnp.linalg.norm(samples[:, 0, dims] - samples[:, 1, dims], axis=-1)
-    ax.hist(d, bins=50, density=True, alpha=0.4)
+    # Bin on the host with numpy, rather than passing the device array to matplotlib's (slow) binning.
+    samples = np.asarray(samples)
+    d = np.linalg.norm(samples[:, 0, dims] - samples[:, 1, dims], axis=-1)
+    counts, bins = np.histogram(d, bins=50, density=True)
+    ax.stairs(counts, bins, alpha=0.4, fill=True)
 
 
 
@@ -55,8 +55,10 @@ def make_dataset(seed: int = 0, n_vertices=2, dim=2, n_samples: int = 8192):
 def plot_sample_hist(samples, ax = None, dim=(0,1)):
     if ax == None:
         fig, ax = plt.subplots()
-    d = jnp.linalg.norm(samples[:, 0, dim] - samples[:, 1, dim], axis=-1)
-    ax.hist(d, bins=50, density=True, alpha=0.4)
+    samples = np.asarray(samples)
+    d = np.linalg.norm(samples[:, 0, dim] - samples[:, 1, dim], axis=-1)
+    counts, bins = np.histogram(d, bins=50, density=True)
+    ax.stairs(counts, bins, alpha=0.4, fill=True)
 
 
 if __name__ == '__main__':
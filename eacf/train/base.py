@@ -1,11 +1,14 @@
 from typing import Callable, Tuple, Optional, Any, Union
+from functools import partial
 
 import chex
 import jax
 import jax.numpy as jnp
 import optax
+import numpy as np
 
 from eacf.utils.base import FullGraphSample
+from eacf.utils.optimize import get_learning_rate
 
 Params = chex.ArrayTree
 
@@ -16,24 +19,27 @@ def setup_padded_reshaped_data(data: chex.ArrayTree,
                                reshape_axis=0) -> Tuple[chex.ArrayTree, chex.Array]:
     test_set_size = jax.tree_util.tree_flatten(data)[0][0].shape[0]
     chex.assert_tree_shape_prefix(data, (test_set_size, ))
+    # Data that is on the host (e.g. before being sharded across devices) is padded and reshaped with numpy, so it
+    # isn't first transferred to the default device.
+    xp = np if all(isinstance(x, np.ndarray) for x in jax.tree_util.tree_leaves(data)) else jnp
 
     padding_amount = (interval_length - test_set_size % interval_length) % interval_length
     test_data_padded_size = test_set_size + padding_amount
-    test_data_padded = jax.tree_map(
-        lambda x: jnp.concatenate([x, jnp.zeros((padding_amount, *x.shape[1:]), dtype=x.dtype)], axis=0), data
+    test_data_padded = jax.tree_util.tree_map(
+        lambda x: xp.concatenate([x, xp.zeros((padding_amount, *x.shape[1:]), dtype=x.dtype)], axis=0), data
     )
-    mask = jnp.zeros(test_data_padded_size, dtype=int).at[jnp.arange(test_set_size)].set(1)
+    mask = (xp.arange(test_data_padded_size) < test_set_size).astype(int)
 
 
     if reshape_axis == 0:  # Used for pmap.
-        test_data_reshaped, mask = jax.tree_map(
-            lambda x: jnp.reshape(x, (interval_length, test_data_padded_size // interval_length, *x.shape[1:])),
+        test_data_reshaped, mask = jax.tree_util.tree_map(
+            lambda x: xp.reshape(x, (interval_length, test_data_padded_size // interval_length, *x.shape[1:])),
             (test_data_padded, mask)
         )
     else:
         assert reshape_axis == 1  # for minibatching
-        test_data_reshaped, mask = jax.tree_map(
-            lambda x: jnp.reshape(x, (test_data_padded_size // interval_length, interval_length, *x.shape[1:])),
+        test_data_reshaped, mask = jax.tree_util.tree_map(
+            lambda x: xp.reshape(x, (test_data_padded_size // interval_length, interval_length, *x.shape[1:])),
             (test_data_padded, mask)
         )
     return test_data_reshaped, mask
@@ -96,7 +102,7 @@ def batchify_array(data: chex.Array, batch_size: int):
 
 
 def batchify_data(data: chex.ArrayTree, batch_size: int):
-    return jax.tree_map(lambda x: batchify_array(x, batch_size), data)
+    return jax.tree_util.tree_map(lambda x: batchify_array(x, batch_size), data)
 
 
 def get_leading_axis_tree(tree: chex.ArrayTree, n_dims: int = 1):
@@ -106,16 +112,26 @@ def get_leading_axis_tree(tree: chex.ArrayTree, n_dims: int = 1):
     return leading_shape
 
 
-def get_shuffle_and_batchify_data_fn(train_data: chex.ArrayTree, batch_size: int):
-    def shuffle_and_batchify_data(train_data_array, key):
-        key, subkey = jax.random.split(key)
-        permutted_train_data = jax.random.permutation(subkey, train_data_array, axis=0)
-        batched_data = batchify_array(permutted_train_data, batch_size)
-        return batched_data
+def get_shuffled_batch_indices(key: chex.PRNGKey, num_datapoints: int, batch_size: int) -> chex.Array:
+    """Indices of a random permutation of the data, reshaped into batches of shape [n_batches, batch_size]."""
+    batch_size = min(batch_size, num_datapoints)
+    n_batches = num_datapoints // batch_size
+    _, subkey = jax.random.split(key)
+    return jnp.reshape(jax.random.permutation(subkey, num_datapoints)[:n_batches * batch_size],
+                       (n_batches, batch_size))
 
-    return lambda key: jax.tree_map(
-        lambda x: shuffle_and_batchify_data(x, key), train_data
-    )
+
+@partial(jax.jit, static_argnames='batch_size')
+def shuffle_and_batchify_data(key: chex.PRNGKey, train_data: chex.ArrayTree, batch_size: int) -> chex.ArrayTree:
+    """Shuffle the data and reshape it into batches of shape [n_batches, batch_size, ...]. The data is an argument
+    (rather than closed over) so that it isn't baked into the executable as a constant."""
+    batch_indices = get_shuffled_batch_indices(key, get_leading_axis_tree(train_data, 1)[0], batch_size)
+    # Gather each leaf straight into its batched shape, rather than permuting the whole array and then reshaping.
+    return jax.tree_util.tree_map(lambda x: x[batch_indices], train_data)
+
+
+def get_shuffle_and_batchify_data_fn(train_data: chex.ArrayTree, batch_size: int):
+    return lambda key: shuffle_and_batchify_data(key, train_data, batch_size)
 
 
 # Training
@@ -133,6 +149,7 @@ def training_step(
     verbose_info: Optional[bool] = False,
     use_pmap: bool = False,
     pmap_axis_name: str = "data",
+    lr: Optional[Union[float, optax.Schedule]] = None,
 ) -> Tuple[Params, optax.OptState, dict]:
     """Compute loss and gradients and update model parameters.
 
@@ -146,6 +163,7 @@ def training_step(
         verbose_info
         use_pmap: whether the training step function is pmapped, such that gradient aggregation is needed.
         pmap_axis_name: name of axis for gradient aggregation across devices.
+        lr: learning rate (or schedule) from `get_optimizer`, used to log the learning rate of each update.
 
 
     Returns:
@@ -164,7 +182,9 @@ def training_step(
         update_norm=optax.global_norm(updates),
         param_norm=optax.global_norm(params),
     )
-    # ΤΟDO: log learning rate
+    learning_rate = get_learning_rate(new_opt_state, lr) if lr is not None else None
+    if learning_rate is not None:
+        info.update(learning_rate=learning_rate)
 
     if verbose_info:
         info.update(
@@ -215,31 +235,37 @@ def create_scan_epoch_fn(
     last_iter_info_only: Optional[bool] = True,
 ):
     scan_fn = create_scan_fn(training_step, last_iter_info_only)
+    # Place the data on device once, rather than transferring it every epoch.
+    data = jax.device_put(data)
 
-    shuffle_and_batchify_data = get_shuffle_and_batchify_data_fn(data, batch_size)
-
-    def scan_epoch(params, opt_state, key):
-        batched_data = shuffle_and_batchify_data(key)
+    def scan_epoch(params, opt_state, key, data):
+        # Only the batch indices are shuffled each epoch, each step gathers its batch from the data, so a shuffled
+        # copy of the whole dataset is never materialised.
+        batch_indices = get_shuffled_batch_indices(key, get_leading_axis_tree(data, 1)[0], batch_size)
+        get_batch = lambda indices: jax.tree_util.tree_map(lambda x: x[indices], data)
 
         if last_iter_info_only:
-            final_batch = batched_data[-1]
-            batched_data = batched_data[:-1]
+            final_batch_indices = batch_indices[-1]
+            batch_indices = batch_indices[:-1]
 
         (params, opt_state, key), info = jax.lax.scan(
-            scan_fn, (params, opt_state, key), batched_data, unroll=1
+            lambda carry, indices: scan_fn(carry, get_batch(indices)), (params, opt_state, key), batch_indices,
+            unroll=1
         )
 
         if last_iter_info_only:
             key, subkey = jax.random.split(key)
             params, opt_state, info = training_step(
                 params,
-                final_batch,
+                get_batch(final_batch_indices),
                 opt_state,
                 subkey,
             )
         return params, opt_state, key, info
 
-    return jax.jit(scan_epoch)
+    # Donate the params and optimizer state, as they are replaced by the returned ones.
+    scan_epoch = jax.jit(scan_epoch, donate_argnums=(0, 1))
+    return lambda params, opt_state, key: scan_epoch(params, opt_state, key, data)
 
 
 # Evaluation
@@ -258,46 +284,69 @@ def eval_fn(
     eval_batch_free_fn: Optional[Callable[[Params, chex.PRNGKey], dict]] = None,
     batch_size: Optional[int] = None,
     mask: Optional[Mask] = None,
+    eval_on_first_test_batch_fn: Optional[Callable[[Params, chex.ArrayTree, chex.PRNGKey, Mask], dict]] = None,
 ) -> Tuple[dict, Optional[FurtherData], Optional[Mask]]:
     info = {}
-    key1, key2 = jax.random.split(key)
+    key1, key2, key3 = jax.random.split(key, 3)
 
     if mask is None:
         mask = jnp.ones(x.positions.shape[0], dtype=int)
 
     if eval_on_test_batch_fn is not None:
 
-        def scan_fn(carry, xs):
-            # Scan over data in the test set. Vmapping all at once causes memory issues I think?
-            x_batch, mask, key = xs
-            info = eval_on_test_batch_fn(
+        (x_batched, mask_batched), mask_batched_new = \
+            setup_padded_reshaped_data((x, mask), interval_length=batch_size, reshape_axis=1)
+        mask_batched = mask_batched * mask_batched_new
+        per_batch_weighting = jnp.sum(mask_batched, axis=-1) / jnp.sum(jnp.sum(mask_batched, axis=-1))
+        batch_keys = jax.random.split(key1, get_leading_axis_tree(x_batched, 1)[0])
+
+        def eval_batch(x_batch, mask, key) -> Tuple[Optional[FurtherData], dict]:
+            batch_info = eval_on_test_batch_fn(
                 params,
                 x_batch,
                 key=key,
                 mask=mask
             )
-            return None, info
-
-        (x_batched, mask_batched), mask_batched_new = \
-            setup_padded_reshaped_data((x, mask), interval_length=batch_size, reshape_axis=1)
-        mask_batched = mask_batched * mask_batched_new
+            if isinstance(batch_info, dict):
+                return None, batch_info
+            return batch_info
+
+        # Aggregate test set info across batches as a running weighted sum in the scan carry, rather than stacking
+        # the info of every batch and reducing afterwards.
+        _, info_shape = jax.eval_shape(eval_batch, *jax.tree_util.tree_map(lambda x: x[0], (x_batched, mask_batched,
+                                                                                     batch_keys)))
+        info_sum = jax.tree_util.tree_map(
+            lambda x: jnp.zeros(x.shape, jnp.result_type(x.dtype, per_batch_weighting.dtype)), info_shape)
+
+        def scan_fn(info_sum, xs):
+            # Scan over data in the test set. Vmapping all at once causes memory issues I think?
+            x_batch, mask, key, weighting = xs
+            further_info, batch_info = eval_batch(x_batch, mask, key)
+            info_sum = jax.tree_util.tree_map(lambda total, x: total + weighting * x, info_sum, batch_info)
+            return info_sum, further_info
 
-        _, batched_info = jax.lax.scan(
+        info_sum, further_info = jax.lax.scan(
             scan_fn,
-            None,
-            (x_batched, mask_batched, jax.random.split(key1, get_leading_axis_tree(x_batched, 1)[0])),
+            info_sum,
+            (x_batched, mask_batched, batch_keys, per_batch_weighting),
         )
-        if isinstance(batched_info, dict):
-            # Aggregate test set info across batches.
-            per_batch_weighting = jnp.sum(mask_batched, axis=-1) / jnp.sum(jnp.sum(mask_batched, axis=-1))
-            info.update(jax.tree_map(lambda x: jnp.sum(per_batch_weighting*x), batched_info))
-            flat_mask, further_info = None, None
+        info.update(info_sum)
+        if further_info is None:
+            flat_mask = None
         else:
-            per_batch_weighting = jnp.sum(mask_batched, axis=-1) / jnp.sum(jnp.sum(mask_batched, axis=-1))
-            info.update(jax.tree_map(lambda x: jnp.sum(per_batch_weighting * x), batched_info[1]))
-            flat_mask, further_info = jax.tree_map(lambda x: x.reshape(x.shape[0]*x.shape[1],
-                                                                        *x.shape[2:]), (mask_batched, batched_info[0]))
+            flat_mask, further_info = jax.tree_util.tree_map(lambda x: x.reshape(x.shape[0]*x.shape[1],
+                                                                        *x.shape[2:]), (mask_batched, further_info))
 
+        if eval_on_first_test_batch_fn is not None:
+            # For checks that are a property of the model rather than the data (e.g. invariances), a single batch
+            # is enough, so they are kept out of the scan over the test set.
+            first_batch_info = eval_on_first_test_batch_fn(
+                params,
+                jax.tree_util.tree_map(lambda x: x[0], x_batched),
+                key=key3,
+                mask=mask_batched[0]
+            )
+            info.update(first_batch_info)
 
     if eval_batch_free_fn is not None:
         non_batched_info = eval_batch_free_fn(
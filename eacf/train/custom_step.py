@@ -1,4 +1,4 @@
-from typing import Callable, Tuple, Optional
+from typing import Callable, Tuple, Optional, Union
 
 import chex
 import jax
@@ -7,7 +7,7 @@ import optax
 
 from eacf.utils.base import FullGraphSample
 from eacf.train.base import get_tree_leaf_norm_info
-from eacf.utils.optimize import CustomOptimizerState
+from eacf.utils.optimize import get_custom_optimizer_state, get_learning_rate
 
 Params = chex.ArrayTree
 
@@ -23,7 +23,8 @@ def training_step(
     ],
     verbose_info: Optional[bool] = False,
     use_pmap: bool = False,
-    pmap_axis_name: str = 'data'
+    pmap_axis_name: str = 'data',
+    lr: Optional[Union[float, optax.Schedule]] = None,
 ) -> Tuple[Params, optax.OptState, dict]:
     """Compute loss and gradients and update model parameters.
 
@@ -37,6 +38,7 @@ def training_step(
         verbose_info
         use_pmap: whether the training step function is pmapped, such that gradient aggregation is needed.
         pmap_axis_name: name of axis for gradient aggregation across devices.
+        lr: learning rate (or schedule) from `get_optimizer`, used to log the learning rate of each update.
 
 
     Returns:
@@ -69,9 +71,13 @@ def training_step(
                 for key, value in get_tree_leaf_norm_info(updates).items()
             }
         )
-    if isinstance(opt_state, CustomOptimizerState):
-        info.update(ignored_grad_count=opt_state.ignored_grads_count,
-                    total_optimizer_steps=opt_state.total_steps)
+    custom_opt_state = get_custom_optimizer_state(opt_state)
+    if custom_opt_state is not None:
+        info.update(ignored_grad_count=custom_opt_state.ignored_grads_count,
+                    total_optimizer_steps=custom_opt_state.total_steps)
+    learning_rate = get_learning_rate(new_opt_state, lr) if lr is not None else None
+    if learning_rate is not None:
+        info.update(learning_rate=learning_rate)
     return new_params, new_opt_state, info
 
 
@@ -97,7 +103,8 @@ def training_step_with_masking(
     ],
     verbose_info: Optional[bool] = False,
     use_pmap: bool = False,
-    pmap_axis_name: str = 'data'
+    pmap_axis_name: str = 'data',
+    lr: Optional[Union[float, optax.Schedule]] = None,
 ) -> Tuple[Params, optax.OptState, dict]:
     """Compute loss and gradients and update model parameters.
 
@@ -111,6 +118,7 @@ def training_step_with_masking(
         verbose_info
         use_pmap: whether the training step function is pmapped, such that gradient aggregation is needed.
         pmap_axis_name: name of axis for gradient aggregation across devices.
+        lr: learning rate (or schedule) from `get_optimizer`, used to log the learning rate of each update.
 
 
     Returns:
@@ -121,8 +129,8 @@ def training_step_with_masking(
                                      in_axes=(0, None, 0, None))(
         key_batch, params, x, verbose_info
     )
-    grad = jax.tree_map(lambda x: mean_with_mask(x, masks), grads)
-    info = jax.tree_map(lambda x: mean_with_mask(x, masks), infos)
+    grad = jax.tree_util.tree_map(lambda x: mean_with_mask(x, masks), grads)
+    info = jax.tree_util.tree_map(lambda x: mean_with_mask(x, masks), infos)
     info.update(masked_points=jnp.sum(~masks))
 
     if use_pmap:
@@ -148,7 +156,11 @@ def training_step_with_masking(
                 for key, value in get_tree_leaf_norm_info(updates).items()
             }
         )
-    if isinstance(opt_state, CustomOptimizerState):
-        info.update(ignored_grad_count=opt_state.ignored_grads_count,
-                    total_optimizer_steps=opt_state.total_steps)
+    custom_opt_state = get_custom_optimizer_state(opt_state)
+    if custom_opt_state is not None:
+        info.update(ignored_grad_count=custom_opt_state.ignored_grads_count,
+                    total_optimizer_steps=custom_opt_state.total_steps)
+    learning_rate = get_learning_rate(new_opt_state, lr) if lr is not None else None
+    if learning_rate is not None:
+        info.update(learning_rate=learning_rate)
     return new_params, new_opt_state, info
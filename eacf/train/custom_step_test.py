@@ -0,0 +1,30 @@
+import jax
+import jax.numpy as jnp
+import optax
+
+from eacf.train.custom_step import training_step
+from eacf.utils.optimize import get_optimizer, OptimizerConfig
+
+
+def test_training_step_logs_optimizer_info_with_grad_accumulation(grad_accum_steps: int = 2, n_steps: int = 4):
+    """Check that the ignored gradient count and optimizer step count are still logged when the optimizer is
+    wrapped in `optax.MultiSteps` for gradient accumulation."""
+    params = {'w': jnp.ones(3)}
+    x = jnp.arange(3.)
+
+    def loss_fn(key, params, x, verbose_info):
+        loss = jnp.sum((params['w'] * x) ** 2)
+        return loss, {'loss': loss}
+
+    optimizer_config = OptimizerConfig(init_lr=1e-3, dynamic_grad_ignore_and_clip=True)
+    optimizer, _ = get_optimizer(optimizer_config)
+    optimizer = optax.MultiSteps(optimizer, every_k_schedule=grad_accum_steps).gradient_transformation()
+    opt_state = optimizer.init(params)
+
+    key = jax.random.PRNGKey(0)
+    for i in range(n_steps):
+        params, opt_state, info = training_step(params, x, opt_state, key, optimizer=optimizer, loss_fn=loss_fn)
+        assert 'ignored_grad_count' in info
+        # The info is for the optimizer state before the update, which only steps every `grad_accum_steps`.
+        assert info['total_optimizer_steps'] == i // grad_accum_steps
+        assert info['ignored_grad_count'] == 0
@@ -1,5 +1,7 @@
-from typing import List, Callable, Any
+from typing import List, Callable, Any, Tuple, NamedTuple
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, lru_cache
 import os
 import jax.numpy as jnp
 import numpy as np
@@ -16,6 +18,160 @@ from eacf.utils.base import FullGraphSample
 from eacf.train.train import TrainingState
 
 
+NDIM = 66
+Z_MATRIX = [
+    (0, [1, 4, 6]),
+    (1, [4, 6, 8]),
+    (2, [1, 4, 0]),
+    (3, [1, 4, 0]),
+    (4, [6, 8, 14]),
+    (5, [4, 6, 8]),
+    (7, [6, 8, 4]),
+    (9, [8, 6, 4]),
+    (10, [8, 6, 4]),
+    (11, [10, 8, 6]),
+    (12, [10, 8, 11]),
+    (13, [10, 8, 11]),
+    (15, [14, 8, 16]),
+    (16, [14, 8, 6]),
+    (17, [16, 14, 15]),
+    (18, [16, 14, 8]),
+    (19, [18, 16, 14]),
+    (20, [18, 16, 19]),
+    (21, [18, 16, 19])
+]
+CART_INDICES = [8, 6, 14]
+IND_CIRC_DIH = [0, 1, 2, 3, 4, 5, 8, 9, 10, 13, 15, 16]
+
+
+def positions_to_torch(positions: chex.Array) -> torch.Tensor:
+    """Flatten positions to `[n_samples, NDIM]` and convert them to a float32 torch tensor. The device array is
+    transferred to host once, with at most a single copy (for the dtype cast / to get a writeable buffer),
+    after which torch shares the numpy memory. Single precision is ample for the histograms computed from the
+    internal coordinates."""
+    positions = np.asarray(positions).reshape(-1, NDIM)
+    positions = np.require(positions, dtype=np.float32, requirements='W')
+    return torch.from_numpy(positions)
+
+
+_CACHE_SIZE = 4
+_transform_cache = {}
+_trajectory_cache = {}
+
+
+def _get_cached(cache: dict, obj: Any, build_fn: Callable[[], Any]) -> Any:
+    """Look up the value built for `obj` in `cache`, calling `build_fn` to create it on a miss. Entries are
+    keyed by the identity of `obj`. The cache holds a reference to `obj`, so its id cannot be reused while the
+    entry is alive."""
+    cache_key = id(obj)
+    if cache_key in cache and cache[cache_key][0] is obj:
+        return cache[cache_key][1]
+    value = build_fn()
+    if len(cache) >= _CACHE_SIZE:
+        cache.pop(next(iter(cache)))
+    cache[cache_key] = (obj, value)
+    return value
+
+
+class InternalCoordinateTransform(NamedTuple):
+    """The coordinate transform, along with the (static) column indices of each group of internal coordinates,
+    extracted from the transform's torch buffers once at construction."""
+    transform: CoordinateTransform
+    bond_columns: np.ndarray
+    angle_columns: np.ndarray
+    dih_columns: np.ndarray
+
+
+def _build_internal_coordinate_transform(train_positions: chex.Array) -> InternalCoordinateTransform:
+    transform = CoordinateTransform(positions_to_torch(train_positions), NDIM, Z_MATRIX, CART_INDICES,
+                                    mode="internal", ind_circ_dih=IND_CIRC_DIH)
+    group_columns = get_internal_group_indices(
+        ncarts=transform.transform.len_cart_inds,
+        permute_inv=transform.transform.permute_inv.cpu().data.numpy(),
+        bond_ind=transform.transform.ic_transform.bond_indices.cpu().data.numpy(),
+        angle_ind=transform.transform.ic_transform.angle_indices.cpu().data.numpy(),
+        dih_ind=transform.transform.ic_transform.dih_indices.cpu().data.numpy())
+    return InternalCoordinateTransform(transform, *group_columns)
+
+
+def get_coordinate_transform(train_positions: chex.Array) -> InternalCoordinateTransform:
+    """Get the internal coordinate transform fit to `train_positions`. The transform is cached so that repeated
+    calls of the plotter with the same training data do not rebuild it."""
+    return _get_cached(_transform_cache, train_positions,
+                       lambda: _build_internal_coordinate_transform(train_positions))
+
+
+@lru_cache(maxsize=None)
+def get_aldp_topology() -> mdtraj.Topology:
+    """The mdtraj topology of alanine dipeptide, built from the OpenMM test system on first use."""
+    aldp = AlanineDipeptideVacuum(constraints=None)
+    return mdtraj.Topology.from_openmm(aldp.topology)
+
+
+def get_reference_trajectory(positions: chex.Array, topology: mdtraj.Topology) -> mdtraj.Trajectory:
+    """Get the mdtraj trajectory of a fixed dataset (e.g. the train or test set), cached such that the
+    positions are only copied to host once."""
+    return _get_cached(_trajectory_cache, positions, lambda: mdtraj.Trajectory(
+        np.asarray(positions).reshape(-1, 22, 3), topology))
+
+
+def get_internal_group_indices(ncarts: int,
+                               permute_inv: np.ndarray,
+                               bond_ind: np.ndarray,
+                               angle_ind: np.ndarray,
+                               dih_ind: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Get the column indices of the bond, angle and dihedral coordinates, for an array over the internal
+    coordinates output by the `CoordinateTransform` with an extra final column of zeros appended. Zero padding
+    the 6 removed degrees of freedom, inverting the permutation and selecting each group is composed into a
+    single gather per group."""
+    n_cart = 3 * ncarts - 6
+    n_internal = len(permute_inv) - 6
+    padded_to_internal = np.concatenate([np.arange(n_cart), np.full(6, n_internal),
+                                         np.arange(n_cart, n_internal)])
+    permuted = padded_to_internal[permute_inv]
+    bond_columns = np.concatenate([np.arange(2), permuted[bond_ind]])
+    angle_columns = np.concatenate([np.arange(2, n_cart), permuted[angle_ind]])
+    dih_columns = permuted[dih_ind]
+    return bond_columns, angle_columns, dih_columns
+
+
+def get_phi_psi(traj: mdtraj.Trajectory) -> Tuple[np.ndarray, np.ndarray]:
+    """Flattened phi and psi dihedral angles of a trajectory."""
+    phi = mdtraj.compute_phi(traj)[1].reshape(-1)
+    psi = mdtraj.compute_psi(traj)[1].reshape(-1)
+    return phi, psi
+
+
+def histogram_densities(samples: List[np.ndarray], edges: np.ndarray) -> np.ndarray:
+    """Density histograms of each array in `samples` over the shared bin `edges`, equivalent to calling
+    `np.histogram(x, edges, density=True)` on each array, but computed with a single `np.bincount` pass over
+    all of the samples. Returns an array of shape `[len(samples), len(edges) - 1]`."""
+    nbins = len(edges) - 1
+    values = np.concatenate(samples)
+    offsets = np.repeat(np.arange(len(samples)) * nbins, [len(x) for x in samples])
+    bin_index = np.searchsorted(edges, values, side='right') - 1
+    bin_index = np.where(values == edges[-1], nbins - 1, bin_index)  # Last bin is closed, as in `np.histogram`.
+    in_range = (bin_index >= 0) & (bin_index < nbins)
+    counts = np.bincount((bin_index + offsets)[in_range], minlength=len(samples) * nbins)
+    counts = np.reshape(counts, (len(samples), nbins))
+    return counts / np.sum(counts, axis=-1, keepdims=True) / np.diff(edges)
+
+
+@partial(jax.jit, static_argnums=(0, 4, 5))
+def sample_n_batches(sample_fn: Callable[[Any, jnp.ndarray, chex.PRNGKey, int], jnp.ndarray],
+                     params: Any,
+                     features: jnp.ndarray,
+                     key: chex.PRNGKey,
+                     n_samples: int,
+                     n_batches: int) -> jnp.ndarray:
+    """Draw `n_batches` batches of `n_samples` from `sample_fn` within a single `jax.lax.scan`, such that
+    all batches are generated by one XLA launch."""
+    def scan_fn(carry, key):
+        return None, sample_fn(params, features, key, n_samples)
+
+    _, positions_x = jax.lax.scan(scan_fn, None, jax.random.split(key, n_batches))
+    return jnp.reshape(positions_x, (n_batches * n_samples, *positions_x.shape[2:]))
+
 
 def eval_and_plot_fn(state: TrainingState,
                      key: chex.PRNGKey,
@@ -30,83 +186,39 @@ def eval_and_plot_fn(state: TrainingState,
                      eval_fn: Callable[[jnp.array, chex.PRNGKey, Any], dict] = None) -> List[plt.Subplot]:
 
     # Set up coordinate transform
-    ndim = 66
-    transform_data = torch.tensor(np.array(train_data.positions).reshape(-1, ndim),
-                                  dtype=torch.float64)
-    z_matrix = [
-        (0, [1, 4, 6]),
-        (1, [4, 6, 8]),
-        (2, [1, 4, 0]),
-        (3, [1, 4, 0]),
-        (4, [6, 8, 14]),
-        (5, [4, 6, 8]),
-        (7, [6, 8, 4]),
-        (9, [8, 6, 4]),
-        (10, [8, 6, 4]),
-        (11, [10, 8, 6]),
-        (12, [10, 8, 11]),
-        (13, [10, 8, 11]),
-        (15, [14, 8, 16]),
-        (16, [14, 8, 6]),
-        (17, [16, 14, 15]),
-        (18, [16, 14, 8]),
-        (19, [18, 16, 14]),
-        (20, [18, 16, 19]),
-        (21, [18, 16, 19])
-    ]
-    cart_indices = [8, 6, 14]
-    ind_circ_dih = [0, 1, 2, 3, 4, 5, 8, 9, 10, 13, 15, 16]
-    transform = CoordinateTransform(transform_data, ndim, z_matrix, cart_indices,
-                                    mode="internal", ind_circ_dih=ind_circ_dih)
+    ndim = NDIM
+    internal_transform = get_coordinate_transform(train_data.positions)
+    transform = internal_transform.transform
 
     # Generate samples
-    params = state.params
-    positions_x = []
-    internal_gen = []
-    internal_test = []
-    for i in range(n_batches):
-        key, key_ = jax.random.split(key)
-        positions_x_ = sample_fn(params, train_data.features[0], key_, n_samples)
-        positions_x_torch = torch.tensor(np.array(positions_x_).reshape(-1, ndim),
-                                         dtype=torch.float64)
-        internal_gen_ = transform.inverse(positions_x_torch)[0].detach().numpy()
-        positions_x.append(positions_x_)
-        internal_gen.append(internal_gen_)
-        if len(test_data.positions) > i * n_samples:
-            key, key_ = jax.random.split(key)
-            end = min((i + 1) * n_samples, len(test_data.positions))
-            positions_x_torch = torch.tensor(np.array(test_data[(i * n_samples):end].positions).reshape(-1, ndim),
-                                             dtype=torch.float64)
-            internal_test_ = transform.inverse(positions_x_torch)[0].detach().numpy()
-            internal_test.append(internal_test_)
-    positions_x = jnp.concatenate(positions_x, axis=0)
-    internal_gen = np.concatenate(internal_gen, axis=0)
-    internal_test = np.concatenate(internal_test, axis=0)
+    key, key_ = jax.random.split(key)
+    positions_x = sample_n_batches(sample_fn, state.params, train_data.features[0], key_, n_samples, n_batches)
+    # Single device to host transfer of all the samples, shared by the transform and the Ramachandran plot.
+    positions_x = np.asarray(positions_x)
+
+    # Map samples and test data to internal coordinates, with a single call of the transform each.
+    n_test = min(n_batches * n_samples, len(test_data.positions))
+    internal_gen = transform.inverse(positions_to_torch(positions_x))[0].detach().numpy()
+    positions_test_torch = positions_to_torch(test_data.positions[:n_test])
+    internal_test = transform.inverse(positions_test_torch)[0].detach().numpy()
 
     # Compute Ramachandran plot angles
-    aldp = AlanineDipeptideVacuum(constraints=None)
-    topology = mdtraj.Topology.from_openmm(aldp.topology)
-    train_traj = mdtraj.Trajectory(np.array(train_data.positions).reshape(-1, 22, 3), topology)
-    test_traj = mdtraj.Trajectory(np.array(test_data.positions).reshape(-1, 22, 3), topology)
-    sampled_traj = mdtraj.Trajectory(np.array(positions_x).reshape(-1, 22, 3), topology)
-    psi_train = mdtraj.compute_psi(train_traj)[1].reshape(-1)
-    phi_train = mdtraj.compute_phi(train_traj)[1].reshape(-1)
-    psi_test = mdtraj.compute_psi(test_traj)[1].reshape(-1)
-    phi_test = mdtraj.compute_phi(test_traj)[1].reshape(-1)
-    psi = mdtraj.compute_psi(sampled_traj)[1].reshape(-1)
-    phi = mdtraj.compute_phi(sampled_traj)[1].reshape(-1)
+    topology = get_aldp_topology()
+    train_traj = get_reference_trajectory(train_data.positions, topology)
+    test_traj = get_reference_trajectory(test_data.positions, topology)
+    sampled_traj = mdtraj.Trajectory(positions_x.reshape(-1, 22, 3), topology)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        (phi_train, psi_train), (phi_test, psi_test), (phi, psi) = executor.map(
+            get_phi_psi, [train_traj, test_traj, sampled_traj])
 
     # Prepare output
     info = {}
 
     # Compute histograms
     nbins = 200
-    htrain_phi, _ = np.histogram(phi_train, nbins, range=[-np.pi, np.pi], density=True);
-    htest_phi, _ = np.histogram(phi_test, nbins, range=[-np.pi, np.pi], density=True);
-    hgen_phi, _ = np.histogram(phi, nbins, range=[-np.pi, np.pi], density=True);
-    htrain_psi, _ = np.histogram(psi_train, nbins, range=[-np.pi, np.pi], density=True);
-    htest_psi, _ = np.histogram(psi_test, nbins, range=[-np.pi, np.pi], density=True);
-    hgen_psi, _ = np.histogram(psi, nbins, range=[-np.pi, np.pi], density=True);
+    angle_edges = np.linspace(-np.pi, np.pi, nbins + 1)
+    htrain_phi, htest_phi, hgen_phi, htrain_psi, htest_psi, hgen_psi = histogram_densities(
+        [phi_train, phi_test, phi, psi_train, psi_test, psi], angle_edges)
 
     # Compute KLDs for phi and psi
     eps = 1e-10
@@ -123,15 +235,14 @@ def eval_and_plot_fn(state: TrainingState,
 
     # Plot phi and psi
     fig1, ax = plt.subplots(1, 2, figsize=(20, 10))
-    x = np.linspace(-np.pi, np.pi, nbins)
-    ax[0].plot(x, htrain_phi, linewidth=3)
-    ax[0].plot(x, htest_phi, linewidth=3)
-    ax[0].plot(x, hgen_phi, linewidth=3)
+    ax[0].stairs(htrain_phi, angle_edges, linewidth=3)
+    ax[0].stairs(htest_phi, angle_edges, linewidth=3)
+    ax[0].stairs(hgen_phi, angle_edges, linewidth=3)
     ax[0].tick_params(axis='both', labelsize=20)
     ax[0].set_xlabel('$\phi$', fontsize=24)
-    ax[1].plot(x, htrain_psi, linewidth=3)
-    ax[1].plot(x, htest_psi, linewidth=3)
-    ax[1].plot(x, hgen_psi, linewidth=3)
+    ax[1].stairs(htrain_psi, angle_edges, linewidth=3)
+    ax[1].stairs(htest_psi, angle_edges, linewidth=3)
+    ax[1].stairs(hgen_psi, angle_edges, linewidth=3)
     ax[1].legend(['Train', 'Test', 'Model'], fontsize=20)
     ax[1].tick_params(axis='both', labelsize=20)
     ax[1].set_xlabel('$\psi$', fontsize=24)
@@ -166,52 +277,27 @@ def eval_and_plot_fn(state: TrainingState,
     # Internal coordinates
     ndim = internal_gen.shape[1]
     hist_range = [-5, 5]
-    hists_test = np.zeros((nbins, ndim))
-    hists_gen = np.zeros((nbins, ndim))
-    for i in range(ndim):
-        htest, _ = np.histogram(internal_test[:, i], nbins, range=hist_range, density=True);
-        hgen, _ = np.histogram(internal_gen[:, i], nbins, range=hist_range, density=True);
-        hists_test[:, i] = htest
-        hists_gen[:, i] = hgen
+    internal_edges = np.linspace(*hist_range, nbins + 1)
+    hists = histogram_densities([*internal_test.T, *internal_gen.T], internal_edges)
+    hists_test = hists[:ndim].T
+    hists_gen = hists[ndim:].T
 
     # Histograms of the groups
-    ncarts = transform.transform.len_cart_inds
-    permute_inv = transform.transform.permute_inv.cpu().data.numpy()
-    bond_ind = transform.transform.ic_transform.bond_indices.cpu().data.numpy()
-    angle_ind = transform.transform.ic_transform.angle_indices.cpu().data.numpy()
-    dih_ind = transform.transform.ic_transform.dih_indices.cpu().data.numpy()
-    hists_test_cart = hists_test[:, :(3 * ncarts - 6)]
-    hists_test_ = np.concatenate([hists_test[:, :(3 * ncarts - 6)],
-                                  np.zeros((nbins, 6)),
-                                  hists_test[:, (3 * ncarts - 6):]], axis=1)
-    hists_test_ = hists_test_[:, permute_inv]
-    hists_test_bond = hists_test_[:, bond_ind]
-    hists_test_angle = hists_test_[:, angle_ind]
-    hists_test_dih = hists_test_[:, dih_ind]
-
-    hists_gen_cart = hists_gen[:, :(3 * ncarts - 6)]
-    hists_gen_ = np.concatenate([hists_gen[:, :(3 * ncarts - 6)],
-                                 np.zeros((nbins, 6)),
-                                 hists_gen[:, (3 * ncarts - 6):]], axis=1)
-    hists_gen_ = hists_gen_[:, permute_inv]
-    hists_gen_bond = hists_gen_[:, bond_ind]
-    hists_gen_angle = hists_gen_[:, angle_ind]
-    hists_gen_dih = hists_gen_[:, dih_ind]
-    hists_test_bond = np.concatenate((hists_test_cart[:, :2],
-                                      hists_test_bond), 1)
-    hists_gen_bond = np.concatenate((hists_gen_cart[:, :2],
-                                     hists_gen_bond), 1)
-    hists_test_angle = np.concatenate((hists_test_cart[:, 2:],
-                                       hists_test_angle), 1)
-    hists_gen_angle = np.concatenate((hists_gen_cart[:, 2:],
-                                      hists_gen_angle), 1)
+    bond_ind = internal_transform.bond_columns
+    angle_ind = internal_transform.angle_columns
+    dih_ind = internal_transform.dih_columns
+    hists_test_ = np.concatenate([hists_test, np.zeros((nbins, 1))], axis=1)
+    hists_gen_ = np.concatenate([hists_gen, np.zeros((nbins, 1))], axis=1)
+    hists_test_bond, hists_test_angle, hists_test_dih = [hists_test_[:, ind] for ind in
+                                                         (bond_ind, angle_ind, dih_ind)]
+    hists_gen_bond, hists_gen_angle, hists_gen_dih = [hists_gen_[:, ind] for ind in
+                                                      (bond_ind, angle_ind, dih_ind)]
 
     label = ['bond', 'angle', 'dih']
     hists_test_list = [hists_test_bond, hists_test_angle,
                        hists_test_dih]
     hists_gen_list = [hists_gen_bond, hists_gen_angle,
                       hists_gen_dih]
-    x = np.linspace(*hist_range, nbins)
     figs_internal = []
     for i in range(len(label)):
         ncol = 4
@@ -225,8 +311,8 @@ def eval_and_plot_fn(state: TrainingState,
         else:
             fig, ax = plt.subplots(5, 4, figsize=(15, 20))
         for j in range(hists_test_list[i].shape[1]):
-            ax[j // ncol, j % ncol].plot(x, hists_test_list[i][:, j])
-            ax[j // ncol, j % ncol].plot(x, hists_gen_list[i][:, j])
+            ax[j // ncol, j % ncol].stairs(hists_test_list[i][:, j], internal_edges)
+            ax[j // ncol, j % ncol].stairs(hists_gen_list[i][:, j], internal_edges)
         ax[0, -1].legend(['Test', 'Model'], fontsize=20)
         figs_internal.append(fig)
 
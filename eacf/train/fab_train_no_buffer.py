@@ -1,6 +1,7 @@
 """Training with FAB. Note assumes fixed conditioning info."""
 
 from typing import Callable, NamedTuple, Tuple
+from functools import partial
 
 import chex
 import jax.numpy as jnp
@@ -126,7 +127,8 @@ def build_fab_no_buffer_init_step_fns(
         smc_state = smc.init(key2)
         return TrainStateNoBuffer(params=flow_params, key=key3, opt_state=opt_state, smc_state=smc_state)
 
-    @jax.jit
+    # The state is donated, as callers always replace it with the returned state.
+    @partial(jax.jit, donate_argnums=(0,))
     @chex.assert_max_traces(4)
     def step(state: TrainStateNoBuffer) -> Tuple[TrainStateNoBuffer, Info]:
         flatten, unflatten, log_p_flat_fn, log_q_flat_fn, flow_log_prob_apply, flow_log_prob_apply_with_extra = \
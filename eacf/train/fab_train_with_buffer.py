@@ -1,11 +1,11 @@
 """Training with FAB. Note assumes fixed conditioning info."""
 
 from typing import Callable, NamedTuple, Tuple, Optional
+from functools import partial
 
 import chex
 import jax.numpy as jnp
 import jax.random
-from jax.flatten_util import ravel_pytree
 import optax
 import numpy as np
 
@@ -14,7 +14,7 @@ from fabjax.buffer import PrioritisedBuffer, PrioritisedBufferState
 from eacf.utils.test import random_rotate_translate_permute
 
 from eacf.flow.aug_flow_dist import AugmentedFlow, AugmentedFlowParams, GraphFeatures, FullGraphSample, Extra
-from eacf.utils.optimize import CustomOptimizerState
+from eacf.utils.optimize import get_custom_optimizer_state
 from eacf.train.fab_train_no_buffer import flat_log_prob_components, build_smc_forward_pass
 
 Params = chex.ArrayTree
@@ -114,7 +114,8 @@ def build_fab_with_buffer_init_step_fns(
         w_adjust_clip: float = 10.,
         equivariance_regularisation: bool = False,
         use_pmap: bool = False,
-        pmap_axis_name: str = 'data'):
+        pmap_axis_name: str = 'data',
+        n_unroll_gradient_updates: int = 1):
     """Create the `init` and `step` functions that define the FAB algorithm."""
     assert smc.alpha == alpha
 
@@ -123,7 +124,14 @@ def build_fab_with_buffer_init_step_fns(
     smc_forward = build_smc_forward_pass(flow, log_p_x, features, smc, batch_size)
     features_with_multiplicity = features[:, None]
     event_shape = (n_nodes, 1 + flow.n_augmented, flow.dim_x)
-    flat_event_shape = np.prod(event_shape)
+    flat_event_shape = int(np.prod(event_shape))
+    # The unflatten and flow log prob functions used in the gradient updates don't depend on the params (they take
+    # them as an argument), so build them once here rather than inside the scanned update. The params-dependent
+    # flat log prob functions returned alongside them are unused.
+    _, unflatten, _, _, _, flow_log_prob_apply_with_extra = flat_log_prob_components(
+        log_p_x=log_p_x, flow=flow, params=None, features_with_multiplicity=features_with_multiplicity,
+        event_shape=event_shape
+    )
 
 
     def init(key: chex.PRNGKey, per_device_key: Optional[chex.PRNGKey] = None) -> TrainStateWithBuffer:
@@ -165,19 +173,18 @@ def build_fab_with_buffer_init_step_fns(
         return TrainStateWithBuffer(params=flow_params, key=key4, opt_state=opt_state,
                                     smc_state=smc_state, buffer_state=buffer_state)
 
+    def grad_diagnostics(grad: AugmentedFlowParams) -> Tuple[chex.Array, chex.Array]:
+        grad_norm = optax.global_norm(grad)
+        max_abs_grad = jax.tree_util.tree_reduce(jnp.maximum, jax.tree_util.tree_map(lambda g: jnp.max(jnp.abs(g)), grad))
+        return grad_norm, max_abs_grad
+
     def one_gradient_update(carry: Tuple[AugmentedFlowParams, optax.OptState],
-                            xs: Tuple[chex.Array, chex.Array, chex.PRNGKey]):
+                            xs: Tuple[chex.Array, chex.Array, chex.PRNGKey, chex.Array]):
         """Perform on update to the flow parameters with a batch of data from the buffer."""
         flow_params, opt_state = carry
-        x, log_q_old, key = xs
+        x, log_q_old, key, log_this_step = xs
         info = {}
 
-        flatten, unflatten, log_p_flat_fn, log_q_flat_fn, flow_log_prob_apply, flow_log_prob_apply_with_extra\
-            = flat_log_prob_components(
-            log_p_x=log_p_x, flow=flow, params=flow_params, features_with_multiplicity=features_with_multiplicity,
-            event_shape=event_shape
-        )
-
         x = unflatten(x)
         # Estimate loss and update flow params.
         grad, (log_w_adjust, log_q, loss_info) = jax.grad(generic_loss, has_aux=True)(
@@ -188,16 +195,21 @@ def build_fab_with_buffer_init_step_fns(
             grad = jax.lax.pmean(grad, axis_name=pmap_axis_name)
         updates, new_opt_state = optimizer.update(grad, opt_state, params=flow_params)
         new_params = optax.apply_updates(flow_params, updates)
-        grad_norm = optax.global_norm(grad)
+        # Only the info of the last update is logged, so skip the reductions over the grad for the other updates.
+        grad_norm, max_abs_grad = jax.lax.cond(
+            log_this_step, grad_diagnostics,
+            lambda grad: jax.tree_util.tree_map(jnp.zeros_like, grad_diagnostics(grad)), grad)
         info.update(loss_info)
         info.update(log10_grad_norm=jnp.log10(grad_norm))  # Makes scale nice for plotting
-        info.update(log10_max_param_grad=jnp.log(jnp.max(ravel_pytree(grad)[0])))
-        if isinstance(opt_state, CustomOptimizerState):
-            info.update(ignored_grad_count=opt_state.ignored_grads_count,
-                        total_optimizer_steps=opt_state.total_steps)
+        info.update(log10_max_param_grad=jnp.log10(max_abs_grad))
+        custom_opt_state = get_custom_optimizer_state(opt_state)
+        if custom_opt_state is not None:
+            info.update(ignored_grad_count=custom_opt_state.ignored_grads_count,
+                        total_optimizer_steps=custom_opt_state.total_steps)
         return (new_params, new_opt_state), (info, log_w_adjust, log_q)
 
-    @jax.jit
+    # The state is donated, as callers always replace it with the returned state.
+    @partial(jax.jit, donate_argnums=(0,))
     @chex.assert_max_traces(4)
     def step(state: TrainStateWithBuffer) -> Tuple[TrainStateWithBuffer, Info]:
         """Perform a single iteration of the FAB algorithm."""
@@ -208,19 +220,20 @@ def build_fab_with_buffer_init_step_fns(
         x_buffer, log_q_old_buffer, indices = buffer.sample_n_batches(subkey, state.buffer_state, batch_size,
                                                                       n_updates_per_smc_forward_pass)
         # Perform sgd steps on flow.
-        key, subkey = jax.random.split(state.key)
+        key, subkey = jax.random.split(key)
         (new_flow_params, new_opt_state), (infos, log_w_adjust, log_q_old) = jax.lax.scan(
             one_gradient_update, init=(state.params, state.opt_state),
-            xs=(x_buffer, log_q_old_buffer, jax.random.split(subkey, n_updates_per_smc_forward_pass)),
-            length=n_updates_per_smc_forward_pass
+            xs=(x_buffer, log_q_old_buffer, jax.random.split(subkey, n_updates_per_smc_forward_pass),
+                jnp.arange(n_updates_per_smc_forward_pass) == n_updates_per_smc_forward_pass - 1),
+            length=n_updates_per_smc_forward_pass,
+            unroll=min(n_unroll_gradient_updates, n_updates_per_smc_forward_pass)
         )
         # Adjust samples in the buffer.
         buffer_state = buffer.adjust(log_q=log_q_old.flatten(), log_w_adjustment=log_w_adjust.flatten(),
                                      indices=indices.flatten(),
                                      buffer_state=state.buffer_state)
-        # Update info.
-        for i in range(n_updates_per_smc_forward_pass):
-            info.update(jax.tree_map(lambda x: x[i], infos))
+        # Update info with that of the last gradient update.
+        info.update(jax.tree_util.tree_map(lambda x: x[-1], infos))
 
         # Run smc and add samples to the buffer. Note this is done with the flow params before they were updated so that
         # this can occur in parallel (jax will do this after compilation).
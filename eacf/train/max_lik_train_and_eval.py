@@ -3,6 +3,7 @@ from typing import Callable, Tuple, Optional
 import chex
 import jax
 import jax.numpy as jnp
+import numpy as np
 
 from eacf.utils.test import random_rotate_translate_permute
 
@@ -96,6 +97,19 @@ def get_tree_leaf_norm_info(tree):
     return info
 
 
+def get_invariance_checks_on_test_batch(params: AugmentedFlowParams,
+                                        x_test: FullGraphSample,
+                                        key: chex.PRNGKey,
+                                        flow: AugmentedFlow,
+                                        mask: Optional[chex.Array] = None) -> dict:
+    """Check the flow's invariances on a batch of test data, joined with a single sample of the augmented variables.
+    These checks are a property of the flow rather than the data, so only need to be run on one batch."""
+    key1, key2 = jax.random.split(key)
+    x_augmented, _ = flow.aux_target_sample_n_and_log_prob_apply(params.aux_target, x_test, key1)
+    joint_sample = flow.separate_samples_to_joint(x_test.features, x_test.positions, x_augmented)
+    return get_checks_for_flow_properties(joint_sample, flow=flow, params=params, key=key2, mask=mask)
+
+
 def get_eval_on_test_batch(params: AugmentedFlowParams,
                            x_test: FullGraphSample,
                            key: chex.PRNGKey,
@@ -106,16 +120,15 @@ def get_eval_on_test_batch(params: AugmentedFlowParams,
 
     key, subkey = jax.random.split(key)
     x_augmented, log_p_a = flow.aux_target_sample_n_and_log_prob_apply(params.aux_target, x_test, subkey, K)
-    x_test = jax.tree_map(lambda x: jnp.repeat(x[None, ...], K, axis=0), x_test)
-    joint_sample = flow.separate_samples_to_joint(x_test.features, x_test.positions, x_augmented)
-
-    log_q = jax.vmap(flow.log_prob_apply, in_axes=(None, 0))(params, joint_sample)
+    # Vmap over the K augmented samples only, rather than first repeating x_test K times.
+    log_q = jax.vmap(lambda x_a: flow.log_prob_apply(
+        params, flow.separate_samples_to_joint(x_test.features, x_test.positions, x_a)))(x_augmented)
     chex.assert_equal_shape((log_p_a, log_q))
     log_w = log_q - log_p_a
 
     info = {}
     info.update(eval_log_lik=maybe_masked_mean(jnp.mean(log_q, axis=0), mask=mask))
-    marginal_log_lik = maybe_masked_mean(jax.nn.logsumexp(log_w, axis=0) - jnp.log(jnp.array(K)),
+    marginal_log_lik = maybe_masked_mean(jax.nn.logsumexp(log_w, axis=0) - float(np.log(K)),
                                          mask=mask)
     info.update(marginal_log_lik=marginal_log_lik)
 
@@ -128,7 +141,8 @@ def get_eval_on_test_batch(params: AugmentedFlowParams,
 
     if test_invariances:
         key, subkey = jax.random.split(key)
-        invariances_info = get_checks_for_flow_properties(joint_sample[0], flow=flow, params=params, key=subkey,
+        joint_sample = flow.separate_samples_to_joint(x_test.features, x_test.positions, x_augmented[0])
+        invariances_info = get_checks_for_flow_properties(joint_sample, flow=flow, params=params, key=subkey,
                                                           mask=mask)
         info.update(invariances_info)
     return info
@@ -146,16 +160,15 @@ def get_eval_on_test_batch_with_further(
     # First copy and paste `get_eval_on_test_batch` function. Then additionally return log_w
     key, subkey = jax.random.split(key)
     x_augmented, log_p_a = flow.aux_target_sample_n_and_log_prob_apply(params.aux_target, x_test, subkey, K)
-    x_test = jax.tree_map(lambda x: jnp.repeat(x[None, ...], K, axis=0), x_test)
-    joint_sample = flow.separate_samples_to_joint(x_test.features, x_test.positions, x_augmented)
-
-    log_q = jax.vmap(flow.log_prob_apply, in_axes=(None, 0))(params, joint_sample)
+    # Vmap over the K augmented samples only, rather than first repeating x_test K times.
+    log_q = jax.vmap(lambda x_a: flow.log_prob_apply(
+        params, flow.separate_samples_to_joint(x_test.features, x_test.positions, x_a)))(x_augmented)
     chex.assert_equal_shape((log_p_a, log_q))
     log_w = log_q - log_p_a
 
     info = {}
     info.update(eval_log_lik=maybe_masked_mean(jnp.mean(log_q, axis=0), mask=mask))
-    marginal_log_lik = maybe_masked_mean(jax.nn.logsumexp(log_w, axis=0) - jnp.log(jnp.array(K)),
+    marginal_log_lik = maybe_masked_mean(jax.nn.logsumexp(log_w, axis=0) - float(np.log(K)),
                                          mask=mask)
     info.update(marginal_log_lik=marginal_log_lik)
 
@@ -166,14 +179,15 @@ def get_eval_on_test_batch_with_further(
 
     if test_invariances:
         key, subkey = jax.random.split(key)
-        invariances_info = get_checks_for_flow_properties(joint_sample[0], flow=flow, params=params, key=subkey,
+        joint_sample = flow.separate_samples_to_joint(x_test.features, x_test.positions, x_augmented[0])
+        invariances_info = get_checks_for_flow_properties(joint_sample, flow=flow, params=params, key=subkey,
                                                           mask=mask)
         info.update(invariances_info)
 
     if target_log_prob is None:
         log_w_joint = log_w[0]
     else:
-        log_w_joint = target_log_prob(x_test.positions[0]) - log_w[0]
+        log_w_joint = target_log_prob(x_test.positions) - log_w[0]
     return log_w_joint, info
 
 
@@ -184,24 +198,31 @@ def eval_non_batched(params: AugmentedFlowParams, single_feature: chex.Array,
                      target_log_prob: Callable = None,
                      target_log_prob_traceable: bool = True):
 
-    def forward(carry, key: chex.PRNGKey):
+    # The samples are only kept if they are needed to evaluate a non-traceable target afterwards, otherwise only the
+    # per-sample log probs are stacked, and the centre of mass norms are accumulated as a running sum.
+    keep_x_positions = target_log_prob is not None and not target_log_prob_traceable
+
+    def forward(aug_orig_norm_sum, key: chex.PRNGKey):
         joint_x_flow, log_prob_flow = flow.sample_and_log_prob_apply(params, single_feature, key, (inner_batch_size,))
         features, x_positions, a_positions = flow.joint_to_separate_samples(joint_x_flow)
         log_p_x = target_log_prob(x_positions) if target_log_prob is not None and target_log_prob_traceable else None
         log_p_a_given_x = flow.aux_target_log_prob_apply(params.aux_target,
                                        FullGraphSample(features=features, positions=x_positions), a_positions)
-        return None, (x_positions, a_positions, log_prob_flow, log_p_x, log_p_a_given_x)
+        original_centre = jnp.mean(x_positions, axis=-2)
+        aug_centre = jnp.mean(a_positions[:, :, 0, :], axis=-2)
+        aug_orig_norm_sum = aug_orig_norm_sum + jnp.sum(jnp.linalg.norm(original_centre-aug_centre, axis=-1))
+        x_positions = x_positions if keep_x_positions else None
+        return aug_orig_norm_sum, (x_positions, log_prob_flow, log_p_x, log_p_a_given_x)
 
     n_batches = int(n_samples // inner_batch_size) + 1
 
-    _, result = jax.lax.scan(forward, None, xs=jax.random.split(key, n_batches), length=n_batches)
-    result = jax.tree_map(lambda x: jnp.reshape(x, (x.shape[0]*x.shape[1], *x.shape[2:])), result)
-    x_positions, a_positions, log_prob_flow, log_p_x, log_p_a_given_x = result  # unpack.
+    aug_orig_norm_sum, result = jax.lax.scan(forward, jnp.zeros(()), xs=jax.random.split(key, n_batches),
+                                             length=n_batches)
+    result = jax.tree_util.tree_map(lambda x: jnp.reshape(x, (x.shape[0]*x.shape[1], *x.shape[2:])), result)
+    x_positions, log_prob_flow, log_p_x, log_p_a_given_x = result  # unpack.
 
     info = {}
-    original_centre = jnp.mean(x_positions, axis=-2)
-    aug_centre = jnp.mean(a_positions[:, :, 0, :], axis=-2)
-    info.update(mean_aug_orig_norm=jnp.mean(jnp.linalg.norm(original_centre-aug_centre, axis=-1)))
+    info.update(mean_aug_orig_norm=aug_orig_norm_sum / (n_batches * inner_batch_size))
 
     if target_log_prob is not None:
         if not target_log_prob_traceable:
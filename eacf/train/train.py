@@ -10,10 +10,9 @@ import os
 import time
 import pathlib
 import optax
-import wandb
 
 from eacf.train.base import get_leading_axis_tree
-from eacf.utils.plotting import plot_history
+from eacf.utils.plotting import plot_history, wait_for_saved_plots
 from eacf.utils.loggers import Logger, ListLogger, WandbLogger
 from eacf.utils.checkpoints import get_latest_checkpoint
 
@@ -102,7 +101,7 @@ def train(config: TrainConfig):
     # Run eval and plot before training starts
     if start_iter == 0:
         key, subkey = jax.random.split(key)
-        eval_info = config.eval_and_plot_fn(state, subkey, -1, config.save, plots_dir)
+        eval_info = jax.device_get(config.eval_and_plot_fn(state, subkey, -1, config.save, plots_dir))
         eval_info.update(iteration=-1)
         config.logger.write(eval_info)
         print(f"initial model eval complete, eval info: \n {eval_info}")
@@ -111,6 +110,8 @@ def train(config: TrainConfig):
 
     for iteration in pbar:
         state, info = config.update_state(state)
+        # Fetch the info to host in a single transfer, rather than syncing once per logged value.
+        info = jax.device_get(info)
 
         # check for scalar info -- usually if last batch info is active
         leading_info_shape = get_leading_axis_tree(info, 1)
@@ -120,15 +121,15 @@ def train(config: TrainConfig):
 
         else:
             for batch_idx in range(leading_info_shape[0]):
-                batch_info = jax.tree_map(lambda x: x[batch_idx], info)
+                batch_info = jax.tree_util.tree_map(lambda x: x[batch_idx], info)
                 batch_info.update(iteration=iteration)
                 config.logger.write(batch_info)
 
         if config.eval_and_plot_fn is not None and iteration in eval_iter:
             key, subkey = jax.random.split(key)
-            eval_info = config.eval_and_plot_fn(
+            eval_info = jax.device_get(config.eval_and_plot_fn(
                 state, subkey, iteration, config.save, plots_dir
-            )
+            ))
             eval_info.update(iteration=iteration)
             pbar.write(str(eval_info))
             config.logger.write(eval_info)
@@ -139,7 +140,7 @@ def train(config: TrainConfig):
             )
             with open(checkpoint_path, "wb") as f:
                 if not config.save_state_all_devices and len(jax.devices()) > 1:
-                    state_first = jax.tree_map(lambda x: x[0], state)
+                    state_first = jax.tree_util.tree_map(lambda x: x[0], state)
                     pickle.dump(state_first, f)
                 else:
                     pickle.dump(state, f)
@@ -161,12 +162,14 @@ def train(config: TrainConfig):
                 ):
                     break
 
+    wait_for_saved_plots()
+
     if isinstance(config.logger, ListLogger):
         plot_history(config.logger.history)
         plt.show()
 
     if isinstance(config.logger, WandbLogger) and config.save:
-        wandb.save(str(pathlib.Path(checkpoints_dir)) + "/*",  base_path=config.save_dir, policy="now")
-        wandb.save(str(pathlib.Path(plots_dir)) + "/*", base_path=config.save_dir, policy="now")
+        config.logger.run.save(str(pathlib.Path(checkpoints_dir)) + "/*",  base_path=config.save_dir, policy="now")
+        config.logger.run.save(str(pathlib.Path(plots_dir)) + "/*", base_path=config.save_dir, policy="now")
 
     return config.logger, state
@@ -1,17 +1,21 @@
+from functools import lru_cache
 from typing import Tuple, Optional
 
 import jax.numpy as jnp
+import numpy as np
 import chex
 
 
+@lru_cache(maxsize=32)
 def get_senders_and_receivers_fully_connected(n_nodes: int) -> Tuple[chex.Array, chex.Array]:
-    receivers = []
-    senders = []
-    for i in range(n_nodes):
-        for j in range(n_nodes - 1):
-            receivers.append(i)
-            senders.append((i + 1 + j) % n_nodes)
-    return jnp.array(senders), jnp.array(receivers)
+    # Built with numpy on the host (static w.r.t. tracing), in the same order as looping over receivers i and
+    # senders (i + 1 + j) % n_nodes for j in range(n_nodes - 1), i.e. all off-diagonal pairs.
+    receivers = np.repeat(np.arange(n_nodes), n_nodes - 1)
+    senders = (receivers + 1 + np.tile(np.arange(n_nodes - 1), n_nodes)) % n_nodes
+    # Cached and shared between callers, so make them read-only.
+    senders.setflags(write=False)
+    receivers.setflags(write=False)
+    return senders, receivers
 
 
 def unflatten_vectors_scalars(vectors: chex.Array, scalars: chex.Array,
@@ -67,5 +71,6 @@ def get_pos_feat_send_receive_flattened_over_multiplicity(
 
 def fill_diagonal(a, val):
     assert a.ndim >= 2
-    i, j = jnp.diag_indices(min(a.shape[-2:]))
-    return a.at[..., i, j].set(val)
+    # Select with a constant diagonal mask, rather than scattering into diagonal indices.
+    diagonal = np.eye(*a.shape[-2:], dtype=bool)
+    return jnp.where(diagonal, jnp.asarray(val, dtype=a.dtype), a)
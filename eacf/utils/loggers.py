@@ -4,7 +4,6 @@ from typing import Any, Dict, List, Mapping, Union, Optional
 import pickle
 import numpy as np
 import pathlib
-import wandb
 import pandas as pd
 import os
 
@@ -78,6 +77,7 @@ class ListLogger(Logger):
 
 class WandbLogger(Logger):
     def __init__(self, **kwargs: Any):
+        import wandb  # Imported lazily as it is slow to import and only needed when logging to wandb.
         self.run = wandb.init(**kwargs, reinit=True)
         self.iter: int = 0
 
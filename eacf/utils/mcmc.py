@@ -26,7 +26,12 @@ def get_samples_simple(log_prob_fn, key, n_vertices: int = 2, dim: int = 2, n_st
             state, _ = jax.vmap(kernel.step)(rng_key_batch, state)
         return state, state.position
 
-    _, positions = jax.lax.scan(one_step, init=state, xs=jax.random.split(rng_key, n_steps + n_warmup_steps))
-    positions = positions[n_warmup_steps:]  # discard warmup positions
-    return jax.tree_map(lambda x: jnp.reshape(x, (x.shape[0] * x.shape[1], *x.shape[2:])), positions)
+    def warmup_step(carry, xs):
+        return one_step(carry, xs)[0], None
+
+    step_keys = jax.random.split(rng_key, n_steps + n_warmup_steps)
+    # Run the warmup without stacking its positions, as they are discarded.
+    state, _ = jax.lax.scan(warmup_step, init=state, xs=step_keys[:n_warmup_steps])
+    _, positions = jax.lax.scan(one_step, init=state, xs=step_keys[n_warmup_steps:])
+    return jax.tree_util.tree_map(lambda x: jnp.reshape(x, (x.shape[0] * x.shape[1], *x.shape[2:])), positions)
 
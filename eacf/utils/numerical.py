@@ -17,6 +17,11 @@ def safe_norm(x: jnp.ndarray, axis: int = None, keepdims=False) -> jnp.ndarray:
     x2 = jnp.sum(x**2, axis=axis, keepdims=keepdims)
     return jnp.where(x2 == 0, 1, x2) ** 0.5
 
+def safe_normalize(x: jnp.ndarray, axis: int = -1) -> jnp.ndarray:
+    """Equivalent to `x / safe_norm(x, axis, keepdims=True)`, but multiplies by rsqrt instead of dividing by sqrt."""
+    x2 = jnp.sum(x**2, axis=axis, keepdims=True)
+    return x * jax.lax.rsqrt(jnp.where(x2 == 0, 1, x2))
+
 def vector_rejection_single(a, b):
     chex.assert_rank(a, 1)
     chex.assert_equal_shape((a, b))
@@ -1,4 +1,4 @@
-from typing import NamedTuple, Tuple, Optional
+from typing import NamedTuple, Tuple, Optional, Union
 
 import chex
 import jax.lax
@@ -6,6 +6,14 @@ import optax
 import jax.numpy as jnp
 
 
+_OPTIMIZERS = {
+    "adam": optax.adam,
+    "adamw": optax.adamw,
+    "sgd": optax.sgd,
+    "rmsprop": optax.rmsprop,
+}
+
+
 class CustomOptimizerState(NamedTuple):
     opt_state: optax.OptState
     grad_norms: chex.Array
@@ -57,7 +65,7 @@ def dynamic_update_ignore_and_grad_norm_clip(optimizer: optax.GradientTransforma
 
         # If grad norm is too big then ignore update.
         updates, new_opt_state, ignored_grad_count = jax.lax.cond(skip_update,
-                              lambda: (jax.tree_map(jnp.zeros_like, updates), opt_state.opt_state,
+                              lambda: (jax.tree_util.tree_map(jnp.zeros_like, updates), opt_state.opt_state,
                                        opt_state.ignored_grads_count + 1),
                               lambda: (updates, new_opt_state, opt_state.ignored_grads_count))
 
@@ -70,6 +78,85 @@ def dynamic_update_ignore_and_grad_norm_clip(optimizer: optax.GradientTransforma
 
 
 
+def zero_nans_and_clip(max_param_grad: Optional[float] = None,
+                       max_global_norm: Optional[float] = None,
+                       skip_if_nan: bool = False) -> optax.GradientTransformation:
+    """Equivalent to chaining `optax.zero_nans`, `optax.clip` and `optax.clip_by_global_norm`, but as a single
+    stateless transform so the gradient tree is only walked once for the element-wise ops.
+
+    If `skip_if_nan` is True, then rather than zeroing NaN gradients element-wise, the whole gradient is zeroed if it
+    contains any NaN. The NaN check is then a single reduction (the global norm) instead of a mask per leaf.
+    """
+
+    def init(params: chex.ArrayTree) -> optax.EmptyState:
+        del params
+        return optax.EmptyState()
+
+    def update(grad: chex.ArrayTree, state: optax.EmptyState, params: Optional[chex.ArrayTree] = None) -> \
+            Tuple[chex.ArrayTree, optax.EmptyState]:
+        del params
+
+        def zero_nan_and_clip_leaf(g: chex.Array) -> chex.Array:
+            if not skip_if_nan:
+                g = jnp.where(jnp.isnan(g), jnp.zeros_like(g), g)
+            if max_param_grad:
+                g = jnp.clip(g, -max_param_grad, max_param_grad)
+            return g
+
+        if skip_if_nan:
+            grad = jax.lax.cond(jnp.isnan(optax.global_norm(grad)),
+                                lambda g: jax.tree_util.tree_map(jnp.zeros_like, g), lambda g: g, grad)
+        grad = jax.tree_util.tree_map(zero_nan_and_clip_leaf, grad)
+        if max_global_norm:
+            grad_norm = optax.global_norm(grad)
+            trigger = grad_norm < max_global_norm
+            grad = jax.tree_util.tree_map(
+                lambda g: jnp.where(trigger, g, (g / grad_norm.astype(g.dtype)) * max_global_norm), grad)
+        return grad, state
+
+    return optax.GradientTransformation(init=init, update=update)
+
+
+def pmean_gradients(axis_name: str) -> optax.GradientTransformation:
+    """Average the gradients over the devices mapped along `axis_name`. Used with `optax.MultiSteps` so that the
+    all-reduce only happens on the steps where the accumulated gradient is applied."""
+
+    def init(params: chex.ArrayTree) -> optax.EmptyState:
+        del params
+        return optax.EmptyState()
+
+    def update(grad: chex.ArrayTree, state: optax.EmptyState, params: Optional[chex.ArrayTree] = None) -> \
+            Tuple[chex.ArrayTree, optax.EmptyState]:
+        del params
+        return jax.lax.pmean(grad, axis_name=axis_name), state
+
+    return optax.GradientTransformation(init=init, update=update)
+
+
+def get_schedule_count(opt_state: optax.OptState) -> Optional[chex.Array]:
+    """Get the step count of the learning rate schedule from an optimizer state, or None if it has no schedule."""
+    if isinstance(opt_state, optax.ScaleByScheduleState):
+        return opt_state.count
+    if isinstance(opt_state, tuple):
+        for sub_state in opt_state:
+            count = get_schedule_count(sub_state)
+            if count is not None:
+                return count
+    return None
+
+
+def get_learning_rate(opt_state: optax.OptState, lr: Union[float, optax.Schedule]) -> Optional[chex.Array]:
+    """Get the learning rate of the most recent update, given the optimizer state and the learning rate (or schedule)
+    returned by `get_optimizer`. For a schedule this is evaluated at the schedule's step count in the optimizer state,
+    so the optimizer state itself doesn't need to store the learning rate. Returns None if the count can't be found."""
+    if not callable(lr):
+        return jnp.asarray(lr)
+    count = get_schedule_count(opt_state)
+    if count is None:
+        return None
+    return lr(jnp.maximum(count - 1, 0))
+
+
 class OptimizerConfig(NamedTuple):
     """Optimizer configuration.
 
@@ -84,6 +171,7 @@ class OptimizerConfig(NamedTuple):
     end_lr: Optional[float] = None
     max_global_norm: Optional[float] = None
     max_param_grad: Optional[float] = None
+    skip_nan_grads: bool = False  # Zero the whole gradient if it has any NaNs, instead of only the NaN elements.
     dynamic_grad_ignore_and_clip: bool = False
     dynamic_grad_ignore_factor: float = 20.
     dynamic_grad_norm_factor: float = 2.
@@ -105,7 +193,17 @@ def get_optimizer(optimizer_config: OptimizerConfig):
     else:
         lr = float(optimizer_config.init_lr)
 
-    main_grad_transform = getattr(optax, optimizer_config.optimizer_name)(lr)  # e.g. adam.
+    # e.g. adam. Names not in `_OPTIMIZERS` are only looked up in optax if needed, and must be optax optimizers that
+    # take the learning rate as their first argument.
+    optimizer_name = optimizer_config.optimizer_name
+    optimizer_fn = _OPTIMIZERS.get(optimizer_name) or getattr(optax, optimizer_name, None)
+    try:
+        main_grad_transform = optimizer_fn(lr) if callable(optimizer_fn) else None
+    except (TypeError, AttributeError):  # E.g. `optax.chain`, which doesn't take a learning rate.
+        main_grad_transform = None
+    if not isinstance(main_grad_transform, optax.GradientTransformation):
+        raise ValueError(f"Unknown optimizer {optimizer_name}, expected the name of an optax optimizer, "
+                         f"e.g. one of {list(_OPTIMIZERS.keys())}.")
 
     if optimizer_config.dynamic_grad_ignore_and_clip:
         optimizer = dynamic_update_ignore_and_grad_norm_clip(
@@ -115,13 +213,8 @@ def get_optimizer(optimizer_config: OptimizerConfig):
             factor_allowable_norm=optimizer_config.dynamic_grad_ignore_factor,
         )
     else:
-        grad_transforms = [optax.zero_nans()]
-        if optimizer_config.max_param_grad:
-            clipping_fn = optax.clip(float(optimizer_config.max_param_grad))
-            grad_transforms.append(clipping_fn)
-        if optimizer_config.max_global_norm:
-            clipping_fn = optax.clip_by_global_norm(float(optimizer_config.max_global_norm))
-            grad_transforms.append(clipping_fn)
-        grad_transforms.append(main_grad_transform)
-        optimizer = optax.chain(*grad_transforms)
+        max_param_grad = float(optimizer_config.max_param_grad) if optimizer_config.max_param_grad else None
+        max_global_norm = float(optimizer_config.max_global_norm) if optimizer_config.max_global_norm else None
+        optimizer = optax.chain(zero_nans_and_clip(max_param_grad, max_global_norm, optimizer_config.skip_nan_grads),
+                                main_grad_transform)
     return optimizer, lr
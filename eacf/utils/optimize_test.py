@@ -0,0 +1,63 @@
+import jax
+import jax.numpy as jnp
+import chex
+import optax
+import pytest
+
+from eacf.utils.optimize import zero_nans_and_clip, get_optimizer, get_learning_rate, OptimizerConfig
+
+
+def test_zero_nans_and_clip_matches_optax_chain():
+    """Check the fused transform gives the same updates as chaining the separate optax transforms."""
+    grad = {'a': jnp.array([1., jnp.nan, -50.]), 'b': jnp.array([[3., 40.], [jnp.nan, 2.]])}
+    for max_param_grad, max_global_norm in [(None, None), (10., None), (None, 5.), (10., 5.), (10., 1000.)]:
+        grad_transforms = [optax.zero_nans()]
+        if max_param_grad:
+            grad_transforms.append(optax.clip(max_param_grad))
+        if max_global_norm:
+            grad_transforms.append(optax.clip_by_global_norm(max_global_norm))
+        expected_transform = optax.chain(*grad_transforms)
+        expected_updates, _ = expected_transform.update(grad, expected_transform.init(grad))
+
+        transform = zero_nans_and_clip(max_param_grad, max_global_norm)
+        updates, _ = jax.jit(transform.update)(grad, transform.init(grad))
+        chex.assert_trees_all_close(updates, expected_updates, rtol=1e-6)
+
+
+def test_zero_nans_and_clip_skip_if_nan():
+    """Check that with `skip_if_nan` the whole gradient is zeroed if it has a NaN, and is clipped otherwise."""
+    grad_with_nan = {'a': jnp.array([1., jnp.nan, -50.]), 'b': jnp.array([[3., 40.], [1., 2.]])}
+    grad = jax.tree_util.tree_map(jnp.nan_to_num, grad_with_nan)
+    for max_param_grad, max_global_norm in [(None, None), (10., None), (None, 5.), (10., 5.)]:
+        transform = zero_nans_and_clip(max_param_grad, max_global_norm, skip_if_nan=True)
+        updates, _ = jax.jit(transform.update)(grad_with_nan, transform.init(grad_with_nan))
+        chex.assert_trees_all_equal(updates, jax.tree_util.tree_map(jnp.zeros_like, grad_with_nan))
+
+        expected_transform = zero_nans_and_clip(max_param_grad, max_global_norm)
+        expected_updates, _ = expected_transform.update(grad, expected_transform.init(grad))
+        updates, _ = jax.jit(transform.update)(grad, transform.init(grad))
+        chex.assert_trees_all_close(updates, expected_updates, rtol=1e-6)
+
+
+def test_get_learning_rate_follows_schedule():
+    """Check the learning rate read from the optimizer state matches the schedule for each update."""
+    params = {'a': jnp.ones(3)}
+    for dynamic_grad_ignore_and_clip in [False, True]:
+        optimizer_config = OptimizerConfig(init_lr=0., use_schedule=True, n_iter_total=10, n_iter_warmup=2,
+                                           peak_lr=1e-3, end_lr=0.,
+                                           dynamic_grad_ignore_and_clip=dynamic_grad_ignore_and_clip)
+        optimizer, lr = get_optimizer(optimizer_config)
+        opt_state = optimizer.init(params)
+        for i in range(4):
+            _, opt_state = optimizer.update(params, opt_state, params=params)
+            chex.assert_trees_all_close(get_learning_rate(opt_state, lr), lr(i))
+
+
+def test_get_optimizer_by_name():
+    """Check optax optimizers outside of the lookup table can be used by name, and other names raise a ValueError."""
+    for optimizer_name in ["adam", "lamb"]:
+        optimizer, _ = get_optimizer(OptimizerConfig(init_lr=1e-3, optimizer_name=optimizer_name))
+        assert isinstance(optimizer, optax.GradientTransformation)
+    for optimizer_name in ["not_an_optimizer", "chain", "global_norm"]:
+        with pytest.raises(ValueError):
+            get_optimizer(OptimizerConfig(init_lr=1e-3, optimizer_name=optimizer_name))
@@ -1,6 +1,8 @@
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Tuple
 
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor, Future
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -13,6 +15,24 @@ from functools import partial
 import matplotlib
 
 
+# Single background worker that writes saved figures to disk, so file I/O overlaps with training. pyplot is not
+# thread safe, so figures are rendered and closed on the calling thread, and only the encoded bytes go to the worker.
+_plot_save_executor: Optional[ThreadPoolExecutor] = None
+_plot_save_future: Optional[Future] = None
+
+
+def _write_files(files: List[Tuple[str, bytes]]):
+    for path, data in files:
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def wait_for_saved_plots():
+    """Block until the figures from the last call to `plot_and_maybe_save` have been written to disk."""
+    if _plot_save_future is not None:
+        _plot_save_future.result()
+
+
 def plot_and_maybe_save(
     plotter,
     state: chex.ArrayTree,
@@ -21,15 +41,24 @@ def plot_and_maybe_save(
     save: bool,
     plots_dir: str,
 ):
+    global _plot_save_executor, _plot_save_future
     figures = plotter(state, key)
-    for j, figure in enumerate(figures):
-        if save:
-            figure.savefig(
-                os.path.join(plots_dir, "plot_%03i_iter_%08i.png" % (j, iteration_n))
-            )
-        else:
+    if save:
+        files = []
+        for j, figure in enumerate(figures):
+            buffer = io.BytesIO()
+            figure.savefig(buffer, format="png")
+            plt.close(figure)
+            files.append((os.path.join(plots_dir, "plot_%03i_iter_%08i.png" % (j, iteration_n)), buffer.getvalue()))
+        # Only keep one set of files in flight, to bound memory.
+        wait_for_saved_plots()
+        if _plot_save_executor is None:
+            _plot_save_executor = ThreadPoolExecutor(max_workers=1)
+        _plot_save_future = _plot_save_executor.submit(_write_files, files)
+    else:
+        for figure in figures:
             plt.show()
-        plt.close(figure)
+            plt.close(figure)
 
 
 def plot_history(history):
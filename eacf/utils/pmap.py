@@ -3,5 +3,12 @@ import chex
 
 def get_from_first_device(nest: chex.ArrayTree, as_numpy: bool = True) -> chex.ArrayTree:
     # Copied from https://github.com/deepmind/acme/blob/d1e69c92000079b118b868ce9303ee6d39c4a0b6/acme/jax/utils.py#L368
-    zeroth_nest = jax.tree_map(lambda x: x[0], nest)
+    zeroth_nest = jax.tree_util.tree_map(lambda x: x[0], nest)
     return jax.device_get(zeroth_nest) if as_numpy else zeroth_nest
+
+
+def get_from_first_shard(nest: chex.ArrayTree) -> chex.ArrayTree:
+    """Like `get_from_first_device` for arrays sharded over their leading axis, but reads the first device's shard
+    directly rather than launching a gather."""
+    first_shard = jax.tree_util.tree_map(lambda x: x.addressable_shards[0].data, nest)
+    return jax.tree_util.tree_map(lambda x: x[0], jax.device_get(first_shard))
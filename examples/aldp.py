@@ -13,7 +13,7 @@ from eacf.train.train import train
 from eacf.train.base import eval_fn
 from eacf.train.eval_aldp import eval_and_plot_fn
 from eacf.flow.build_flow import build_flow
-from eacf.train.max_lik_train_and_eval import get_eval_on_test_batch
+from eacf.train.max_lik_train_and_eval import get_eval_on_test_batch, get_invariance_checks_on_test_batch
 
 
 @hydra.main(config_path="./config", config_name="aldp.yaml")
@@ -41,20 +41,23 @@ def run(cfg: DictConfig):
     flow_config = create_flow_config(cfg)
     flow = build_flow(flow_config)
 
-    # Sample function for eval
-    flow_sample_fn = jax.jit(flow.sample_apply, static_argnums=3)
-    separate_samples_fn = jax.jit(flow.joint_to_separate_samples)
+    # Sample function for eval. Sampling and separating are jitted together so XLA fuses them into one program.
+    # The joint sample is an intermediate of this program, so XLA already reuses its buffer. No arguments are
+    # donated: the params are reused after the call, and the key is too small for donation to matter.
+    @partial(jax.jit, static_argnums=3)
     def sample_fn(params: Any, features: jnp.array, key: jnp.array, n_samples: int):
-        joint_samples_flow = flow_sample_fn(params, features, key,
-                                            (n_samples,))
-        _, positions_x, _ = separate_samples_fn(joint_samples_flow)
+        joint_samples_flow = flow.sample_apply(params, features, key,
+                                               (n_samples,))
+        _, positions_x, _ = flow.joint_to_separate_samples(joint_samples_flow)
         return positions_x
 
     # Create eval function
     eval_on_test_batch_fn = partial(get_eval_on_test_batch,
                                     flow=flow, K=cfg.training.K_marginal_log_lik,
-                                    test_invariances=True)
+                                    test_invariances=False)
+    eval_on_first_test_batch_fn = partial(get_invariance_checks_on_test_batch, flow=flow)
     eval_fn_ = partial(eval_fn, eval_on_test_batch_fn=eval_on_test_batch_fn,
+                       eval_on_first_test_batch_fn=eval_on_first_test_batch_fn,
                        eval_batch_free_fn=None, batch_size=cfg.training.plot_batch_size)
     eval_and_plot_fn_ = partial(eval_and_plot_fn, sample_fn=sample_fn, train_data=train_set, test_data=val_set,
                                 n_samples=cfg.training.plot_batch_size, n_batches=cfg.eval.plot_n_batches,
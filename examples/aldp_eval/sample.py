@@ -1,6 +1,7 @@
 import pickle
 from typing import Any
 
+from functools import partial
 import pathlib
 import os
 import hydra
@@ -47,13 +48,12 @@ def run(cfg: DictConfig):
     flow_config = create_flow_config(cfg)
     flow = build_flow(flow_config)
 
-    # Sample function for eval
-    flow_sample_fn = jax.jit(flow.sample_and_log_prob_apply, static_argnums=3)
-    separate_samples_fn = jax.jit(flow.joint_to_separate_samples)
+    # Sample function for eval. Sampling and separating are jitted together so XLA fuses them into one program.
+    @partial(jax.jit, static_argnums=3)
     def sample_fn(params: Any, features: jnp.array, key: jnp.array, n_samples: int):
-        joint_samples_flow, log_q = flow_sample_fn(params, features, key,
-                                                   (n_samples,))
-        _, positions_x, positions_a = separate_samples_fn(joint_samples_flow)
+        joint_samples_flow, log_q = flow.sample_and_log_prob_apply(params, features, key,
+                                                                   (n_samples,))
+        _, positions_x, positions_a = flow.joint_to_separate_samples(joint_samples_flow)
         return positions_x, positions_a, log_q
 
     # Load checkpoint
@@ -65,18 +65,18 @@ def run(cfg: DictConfig):
     # Sample
     prng_seq = hk.PRNGSequence(seed)
     features = jnp.arange(22, dtype=int)[:, None]
-    positions_x = []
-    positions_a = []
-    log_q = []
-    for _ in range(n_batches):
+    # Write each batch straight into preallocated host buffers, rather than concatenating a list of batches.
+    positions_x, positions_a, log_q = None, None, None
+    for i in range(n_batches):
         positions_x_, positions_a_, log_q_ = sample_fn(state.params, features,
                                                        next(prng_seq), n_samples)
-        positions_x.append(np.array(positions_x_))
-        positions_a.append(np.array(positions_a_))
-        log_q.append(np.array(log_q_))
-    positions_x = np.concatenate(positions_x)
-    positions_a = np.concatenate(positions_a)
-    log_q = np.concatenate(log_q)
+        if i == 0:
+            positions_x, positions_a, log_q = [np.empty((n_batches * n_samples, *x.shape[1:]), dtype=x.dtype)
+                                               for x in (positions_x_, positions_a_, log_q_)]
+        batch_slice = slice(i * n_samples, (i + 1) * n_samples)
+        positions_x[batch_slice] = positions_x_
+        positions_a[batch_slice] = positions_a_
+        log_q[batch_slice] = log_q_
 
     # Save results
     sample_dir = os.path.join(cfg.training.save_dir, f"samples")
@@ -23,7 +23,7 @@ def load_dataset_custom(batch_size, train_set_size: int = 1000, test_set_size:in
                            temperature=temperature)
 
     train_set = dataset[:train_set_size]
-    train_set = train_set[:train_set_size - (train_set.shape[0] % batch_size)]
+    train_set = train_set[:train_set.shape[0] - (train_set.shape[0] % batch_size)]
 
     test_set = dataset[-test_set_size:]
     return positional_dataset_only_to_full_graph(train_set), positional_dataset_only_to_full_graph(test_set)